@@ -0,0 +1,229 @@
+"""
+Build a training mixture from tokenized datasets with a token budget per source.
+
+Every source is a merged dataset (or any .bin/.idx prefix) written by
+`preprocess_data_parallel.py` with the same tokenizer. Documents are sampled
+by index: whole epochs of a source first (upsampling), then a seeded random
+subset up to its budget. The mixture is written in one streaming pass that
+copies adjacent documents in sequential runs, so nothing is retokenized or
+merged again.
+"""
+
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+
+from preprocess_data_parallel import (
+    copy_byte_range,
+    gather_sequences,
+    load_document_sources,
+    write_document_sources,
+    write_index,
+)
+
+_TOKEN_SUFFIXES = {"K": 10**3, "M": 10**6, "B": 10**9, "T": 10**12}
+
+
+def parse_budget(budget):
+    """
+    Parse a token budget: a token count like 20B, 300M or 1.5e9, or xN for N epochs of the source.
+
+    Returns:
+        Tuple of ("tokens", count) or ("epochs", count)
+    """
+    try:
+        if budget[:1] in ("x", "X"):
+            return "epochs", float(budget[1:])
+        if budget[-1:].upper() in _TOKEN_SUFFIXES:
+            return "tokens", int(float(budget[:-1]) * _TOKEN_SUFFIXES[budget[-1].upper()])
+        return "tokens", int(float(budget))
+    except ValueError:
+        raise ValueError(f"Invalid token budget {budget!r}, expected e.g. 20B, 1.5e9 or x2")
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--source",
+        type=str,
+        nargs=2,
+        action="append",
+        required=True,
+        metavar=("PREFIX", "BUDGET"),
+        help="Dataset prefix (e.g. <output-dir>/merged) and its token budget, "
+        "e.g. 20B or x2 for two epochs. Repeat for every source.",
+    )
+    parser.add_argument(
+        "--output-prefix", type=str, required=True, help="Prefix of the mixture .bin/.idx."
+    )
+    parser.add_argument("--seed", type=int, default=1234, help="Seed of the document sampling.")
+    parser.add_argument(
+        "--shuffle",
+        action="store_true",
+        help="Interleave the documents of all sources in a random order. Reads "
+        "the sources randomly instead of sequentially.",
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        args.source = [(prefix, parse_budget(budget)) for prefix, budget in args.source]
+    except ValueError as e:
+        parser.error(str(e))
+    output_prefix = os.path.abspath(args.output_prefix)
+    if any(os.path.abspath(prefix) == output_prefix for prefix, _ in args.source):
+        parser.error("--output-prefix must differ from every --source prefix")
+
+    return args
+
+
+def get_document_tokens(index):
+    """Number of tokens of every document of an index."""
+    sequence_ends = np.concatenate([[0], np.cumsum(index.sequence_lengths, dtype=np.int64)])
+    return np.diff(sequence_ends[np.asarray(index.document_indices)])
+
+
+def sample_documents(document_tokens, budget_tokens, rng):
+    """
+    Pick documents totalling about `budget_tokens`, overshooting by at most one document.
+
+    Budgets larger than the source repeat all documents once per whole epoch,
+    the remainder is a random subset. Every pass is in document order, so it
+    reads the source sequentially.
+    """
+    total_tokens = int(document_tokens.sum())
+    if total_tokens == 0:
+        return np.zeros(0, dtype=np.int64)
+    epochs, remainder = divmod(budget_tokens, total_tokens)
+    passes = [np.arange(len(document_tokens))] * epochs
+    if remainder > 0:
+        order = rng.permutation(len(document_tokens))
+        take = np.searchsorted(np.cumsum(document_tokens[order]), remainder) + 1
+        passes.append(np.sort(order[:take]))
+    return np.concatenate(passes + [np.zeros(0, dtype=np.int64)])
+
+
+def build_mixture(sources, output_prefix, seed, shuffle=False):
+    """
+    Sample every source to its budget and write the mixture to `output_prefix`.
+
+    Args:
+        sources: List of (path prefix, (kind, budget)) as returned by `get_args`
+        output_prefix: Prefix of the mixture
+        seed: Seed of the sampling and of the order with `shuffle`
+        shuffle: Write the documents in a random order instead of source by source
+
+    Returns:
+        List of per-source statistics, also written to <output_prefix>_mixture.json
+    """
+    from megatron.core.datasets.indexed_dataset import IndexedDataset, get_bin_path, get_idx_path
+
+    rng = np.random.default_rng(seed)
+    dtype = None
+    names = []
+    stats = []
+    # per selected sequence: its source, length and byte offset in the source .bin
+    sequence_sources, sequence_lengths, sequence_pointers = [], [], []
+    # per selected document: its first sequence and its provenance id
+    document_indices, document_sources = [np.zeros(1, dtype=np.int64)], []
+    for source, (prefix, (kind, budget)) in enumerate(sources):
+        index = IndexedDataset(prefix).index
+        if dtype is None:
+            dtype = index.dtype
+        elif index.dtype != dtype:
+            raise ValueError(f"{prefix} has dtype {index.dtype.__name__}, not {dtype.__name__}")
+
+        document_tokens = get_document_tokens(index)
+        total_tokens = int(document_tokens.sum())
+        budget_tokens = int(budget * total_tokens) if kind == "epochs" else budget
+        documents = sample_documents(document_tokens, budget_tokens, rng)
+        sequences, source_document_indices = gather_sequences(
+            np.asarray(index.document_indices), documents
+        )
+
+        sequence_sources.append(np.full(len(sequences), source, dtype=np.int32))
+        sequence_lengths.append(np.asarray(index.sequence_lengths)[sequences])
+        sequence_pointers.append(np.asarray(index.sequence_pointers)[sequences])
+        offset = sum(len(lengths) for lengths in sequence_lengths[:-1])
+        document_indices.append(source_document_indices[1:] + offset)
+
+        source_names, source_ids = load_document_sources(prefix)
+        document_sources.append(source_ids[documents].astype(np.uint32) + len(names))
+        names.extend(f"{prefix}:{name}" for name in source_names)
+
+        selected_tokens = int(document_tokens[documents].sum())
+        stats.append(
+            {
+                "source": prefix,
+                "budget_tokens": budget_tokens,
+                "available_tokens": total_tokens,
+                "tokens": selected_tokens,
+                "documents": len(documents),
+                "epochs": selected_tokens / total_tokens if total_tokens else 0.0,
+            }
+        )
+        logging.info(
+            f"{prefix}: {selected_tokens} of {budget_tokens} budgeted tokens, "
+            f"{len(documents)} documents ({stats[-1]['epochs']:.2f} epochs)"
+        )
+
+    sequence_sources = np.concatenate(sequence_sources)
+    sequence_lengths = np.concatenate(sequence_lengths)
+    sequence_pointers = np.concatenate(sequence_pointers)
+    document_indices = np.concatenate(document_indices)
+    document_sources = np.concatenate(document_sources)
+
+    if shuffle:
+        order = rng.permutation(len(document_sources))
+        sequences, document_indices = gather_sequences(document_indices, order)
+        sequence_sources = sequence_sources[sequences]
+        sequence_lengths = sequence_lengths[sequences]
+        sequence_pointers = sequence_pointers[sequences]
+        document_sources = document_sources[order]
+
+    # copy maximal runs of sequences that are adjacent in the same source .bin
+    sequence_bytes = sequence_lengths.astype(np.int64) * np.dtype(dtype).itemsize
+    ends = sequence_pointers + sequence_bytes
+    breaks = np.flatnonzero(
+        (sequence_sources[1:] != sequence_sources[:-1]) | (sequence_pointers[1:] != ends[:-1])
+    ) + 1
+    run_starts = np.concatenate([[0], breaks])
+    run_ends = np.concatenate([breaks, [len(sequence_lengths)]])
+    os.makedirs(os.path.dirname(os.path.abspath(output_prefix)), exist_ok=True)
+    source_files = [open(get_bin_path(prefix), "rb") for prefix, _ in sources]
+    with open(get_bin_path(output_prefix), "wb") as fout:
+        for first, last in zip(run_starts.tolist(), run_ends.tolist()):
+            if first < last:
+                copy_byte_range(
+                    source_files[sequence_sources[first]],
+                    fout,
+                    int(sequence_pointers[first]),
+                    int(ends[last - 1]),
+                )
+    for f in source_files:
+        f.close()
+    logging.info(f"Copied {len(run_starts)} runs of documents")
+
+    # one pointer per sequence, also for an empty mixture
+    output_pointers = np.concatenate([[0], np.cumsum(sequence_bytes)])[:-1].astype(np.int64)
+    write_index(get_idx_path(output_prefix), dtype, sequence_lengths, output_pointers, document_indices)
+    write_document_sources(output_prefix, names, document_sources)
+    with open(output_prefix + "_mixture.json", "w") as f:
+        json.dump({"seed": seed, "shuffle": shuffle, "sources": stats}, f, indent=1)
+    return stats
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    args = get_args(argv)
+    stats = build_mixture(args.source, args.output_prefix, args.seed, shuffle=args.shuffle)
+    logging.info(
+        f"Wrote {args.output_prefix}: {sum(s['tokens'] for s in stats)} tokens, "
+        f"{sum(s['documents'] for s in stats)} documents"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Build new datasets from a document selection of an existing merged dataset.
+
+Documents are selected by source (the `merged_sources.npy` / `.json` files
+written by `preprocess_data_parallel.py`), by an explicit index array, and can
+be split randomly, e.g. into train and validation sets. By default the new
+.idx points into the original .bin, which is hard-linked, so nothing is
+copied; with --copy the selected documents are copied in sequential runs.
+"""
+
+import argparse
+import fnmatch
+import logging
+import os
+
+import numpy as np
+
+from preprocess_data_parallel import build_subset, load_document_sources, write_document_sources
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input-prefix",
+        type=str,
+        required=True,
+        help="Prefix of the dataset to select from, e.g. <output-dir>/merged.",
+    )
+    parser.add_argument(
+        "--output-prefix",
+        type=str,
+        required=True,
+        help="Prefix of the new dataset; with --split, _<name> is appended per split.",
+    )
+    parser.add_argument(
+        "--include-sources",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Only keep documents whose source name matches one of these glob "
+        "patterns, e.g. '*python*'.",
+    )
+    parser.add_argument(
+        "--exclude-sources",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Drop documents whose source name matches one of these glob patterns.",
+    )
+    parser.add_argument(
+        "--documents",
+        type=str,
+        default=None,
+        help=".npy file with the document indices (or a boolean mask) to keep.",
+    )
+    parser.add_argument(
+        "--split",
+        type=str,
+        nargs="+",
+        default=None,
+        metavar="NAME=FRACTION",
+        help="Randomly split the selected documents, e.g. train=0.99 valid=0.01. "
+        "Fractions summing to less than 1 leave the rest out.",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=1234, help="Seed of the --split assignment."
+    )
+    parser.add_argument(
+        "--copy",
+        action="store_true",
+        help="Copy the selected documents into a new .bin instead of hard-linking "
+        "the input .bin. A link keeps the input's tokens on disk even after "
+        "its merged dataset is rebuilt.",
+    )
+    args = parser.parse_args(argv)
+
+    if args.split:
+        splits = []
+        for spec in args.split:
+            name, sep, fraction = spec.partition("=")
+            try:
+                splits.append((name, float(fraction)))
+            except ValueError:
+                parser.error(f"Invalid --split {spec!r}, expected NAME=FRACTION")
+            if not sep or not name:
+                parser.error(f"Invalid --split {spec!r}, expected NAME=FRACTION")
+        if sum(fraction for _, fraction in splits) > 1 + 1e-9:
+            parser.error("--split fractions sum to more than 1")
+        args.split = splits
+
+    # the output .bin is replaced before the input is read
+    output_prefixes = [f"{args.output_prefix}_{name}" for name, _ in args.split or []]
+    output_prefixes = [os.path.abspath(prefix) for prefix in output_prefixes or [args.output_prefix]]
+    if os.path.abspath(args.input_prefix) in output_prefixes:
+        parser.error("--output-prefix must not overwrite --input-prefix")
+
+    return args
+
+
+def select_documents(args, names, sources):
+    """Indices of the documents matching the source patterns and --documents, in order."""
+    selected = np.ones(len(sources), dtype=bool)
+    for patterns, include in ((args.include_sources, True), (args.exclude_sources, False)):
+        if not patterns:
+            continue
+        ids = [
+            i for i, name in enumerate(names)
+            if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+        ]
+        logging.info(f"{len(ids)} of {len(names)} sources match {' '.join(patterns)}")
+        matches = np.isin(sources, ids)
+        selected &= matches if include else ~matches
+    if args.documents:
+        chosen = np.load(args.documents)
+        if chosen.dtype == bool:
+            assert len(chosen) == len(sources), "--documents mask does not match the dataset"
+            selected &= chosen
+        else:
+            mask = np.zeros(len(sources), dtype=bool)
+            mask[chosen] = True
+            selected &= mask
+    return np.flatnonzero(selected)
+
+
+def split_documents(documents, splits, seed):
+    """Assign `documents` randomly to the (name, fraction) `splits`, each kept in order."""
+    shuffled = np.random.default_rng(seed).permutation(documents)
+    bounds = np.round(np.cumsum([0.0] + [fraction for _, fraction in splits]) * len(documents))
+    bounds = np.minimum(bounds.astype(np.int64), len(documents))
+    return {
+        name: np.sort(shuffled[bounds[i] : bounds[i + 1]])
+        for i, (name, _) in enumerate(splits)
+    }
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    args = get_args(argv)
+
+    names, sources = load_document_sources(args.input_prefix)
+    documents = select_documents(args, names, sources)
+    logging.info(f"Selected {len(documents)} of {len(sources)} documents")
+
+    if args.split:
+        outputs = {
+            f"{args.output_prefix}_{name}": split
+            for name, split in split_documents(documents, args.split, args.seed).items()
+        }
+    else:
+        outputs = {args.output_prefix: documents}
+
+    for output_prefix, subset in outputs.items():
+        os.makedirs(os.path.dirname(os.path.abspath(output_prefix)), exist_ok=True)
+        num_tokens = build_subset(args.input_prefix, output_prefix, subset, copy=args.copy)
+        write_document_sources(output_prefix, names, sources[subset])
+        logging.info(f"Wrote {output_prefix}: {len(subset)} documents, {num_tokens} tokens")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,331 +1,2474 @@
 import argparse
+import bisect
 import math
 import json
 import os
 import time
 import gzip
 import glob
+import hashlib
+import itertools
 import multiprocessing
-
-try:
-    import nltk
-    from nltk.tokenize.punkt import PunktLanguageVars
-
-    nltk_available = True
-except ImportError:
-    PunktLanguageVars = object  # Fallback to the built-in object class
-    nltk_available = False
-
-from megatron.training.tokenizer import build_tokenizer
-from megatron.training.arguments import _add_tokenizer_args
-from megatron.core.datasets import indexed_dataset
-from tools.preprocess_data import get_file_name, check_files_exist, Partition
-from megatron.core.datasets.indexed_dataset import (
-    IndexedDataset,
-    IndexedDatasetBuilder,
-    get_bin_path,
-    get_idx_path,
-)
-
-import ray
+import operator
+import queue
+import re
+import resource
+import sys
+import threading
+import zlib
 import shutil
+import struct
 import logging
 
-parser = argparse.ArgumentParser()
-
-parser = _add_tokenizer_args(parser)
-parser.add_argument(
-    "--cpus-per-ray-worker", type=int, default=1, help="Number of CPUs per worker"
-)
-group = parser.add_argument_group(title="input data")
-group.add_argument("--input", type=str, required=True, help="Path to input JSON")
-group.add_argument(
-    "--json-keys",
-    nargs="+",
-    default=["text"],
-    help="space separate listed of keys to extract from json",
-)
-group.add_argument(
-    "--split-sentences", action="store_true", help="Split documents into sentences."
-)
-group.add_argument(
-    "--keep-newlines",
-    action="store_true",
-    help="Keep newlines between sentences when splitting.",
-)
-group = parser.add_argument_group(title="tokenization process")
-group.add_argument(
-    "--append-eod",
-    action="store_true",
-    help="Append an <eod> token to the end of a document.",
-)
-group.add_argument(
-    "--lang",
-    type=str,
-    default="english",
-    help="Language to use for NLTK-powered sentence splitting.",
-)
-group = parser.add_argument_group(title="output data")
-group.add_argument(
-    "--output-prefix",
-    type=str,
-    required=True,
-    help="Path to binary output file without suffix",
-)
-group = parser.add_argument_group(title="runtime")
-group.add_argument(
-    "--workers",
-    type=int,
-    required=True,
-    help=(
-        "Number of worker processes to launch."
-        "A good default for fast pre-processing "
-        "is: (workers * partitions) = available CPU cores."
-    ),
-)
-group.add_argument(
-    "--partitions", type=int, default=1, help="Number of file partitions"
-)
-group.add_argument(
-    "--log-interval", type=int, default=1000, help="Interval between progress updates"
-)
-group.add_argument(
-    "--keep-sequential-samples",
-    action="store_true",
-    help="Ensure ordering of samples in .jsonl files is "
-    "preserved when using partitions>1.",
-)
-
-args = parser.parse_args()
-
-
-def preprocess_data(args):
-    if args.split_sentences:
-        if nltk_available:
-            nltk.download("punkt", quiet=True, download_dir=os.environ.get("NLTK_DATA"))
-        else:
-            raise Exception(
-                "nltk library required for sentence splitting is not available."
-            )
+import numpy as np
+
+# Megatron, Ray and NLTK are imported lazily inside the functions that need
+# them, so importing this module (e.g. in spawned workers or other drivers)
+# stays cheap and never parses sys.argv.
+
+
+def get_args(argv=None):
+    """Parse the command line (or `argv`) into the driver configuration."""
+    from megatron.training.arguments import _add_tokenizer_args
+
+    parser = argparse.ArgumentParser()
+
+    parser = _add_tokenizer_args(parser)
+    parser.add_argument(
+        "--cpus-per-ray-worker", type=int, default=1, help="Number of CPUs per worker"
+    )
+    parser.add_argument(
+        "--tokenizers",
+        nargs="+",
+        default=None,
+        metavar="NAME=TYPE:MODEL",
+        help="Encode with several tokenizers in a single read and decode pass, e.g. "
+        "cosmo2=HuggingFaceTokenizer:/path/to/cosmo2. Each tokenizer gets its own "
+        "output under <output-prefix>/NAME/. Other tokenizer arguments are shared.",
+    )
+    group = parser.add_argument_group(title="input data")
+    group.add_argument(
+        "--input",
+        type=str,
+        nargs="+",
+        required=True,
+        help="Directories of input .jsonl files. Several directories share one "
+        "Ray work queue and are paired with --output-prefix in order.",
+    )
+    group.add_argument(
+        "--json-keys",
+        nargs="+",
+        default=["text"],
+        help="space separate listed of keys to extract from json",
+    )
+    group.add_argument(
+        "--split-sentences", action="store_true", help="Split documents into sentences."
+    )
+    group.add_argument(
+        "--keep-newlines",
+        action="store_true",
+        help="Keep newlines between sentences when splitting.",
+    )
+    group.add_argument(
+        "--filter",
+        type=str,
+        action="append",
+        default=[],
+        metavar="COLUMN OP VALUE",
+        help="Only keep documents matching this condition, e.g. 'int_score>=3' or "
+        "'language==Python'. OP is one of >=, <=, ==, !=, >, <; VALUE is parsed as "
+        "JSON, else taken as a string. Nested columns are written with dots. "
+        "Repeat to require several conditions. Pushed down to row-group "
+        "statistics for Parquet and Arrow inputs.",
+    )
+    group.add_argument(
+        "--min-chars",
+        type=int,
+        default=None,
+        help="Only keep documents with at least this many characters in --json-keys.",
+    )
+    group.add_argument(
+        "--max-chars",
+        type=int,
+        default=None,
+        help="Only keep documents with at most this many characters in --json-keys.",
+    )
+    group = parser.add_argument_group(title="tokenization process")
+    group.add_argument(
+        "--append-eod",
+        action="store_true",
+        help="Append an <eod> token to the end of a document.",
+    )
+    group.add_argument(
+        "--lang",
+        type=str,
+        default="english",
+        help="Language to use for NLTK-powered sentence splitting.",
+    )
+    group.add_argument(
+        "--long-doc-chars",
+        type=int,
+        default=0,
+        help="Split documents longer than this many characters into segments "
+        "that are encoded in parallel and stitched back into one document "
+        "(0 disables). Exact for byte-level BPE tokenizers, see split_long_text. "
+        "Not applied with --split-sentences.",
+    )
+    group.add_argument(
+        "--long-doc-segment-chars",
+        type=int,
+        default=100000,
+        help="Approximate segment size used by --long-doc-chars.",
+    )
+    group = parser.add_argument_group(title="output data")
+    group.add_argument(
+        "--output-prefix",
+        type=str,
+        nargs="+",
+        required=True,
+        help="Output directory per --input directory, each gets its own merged.bin/.idx",
+    )
+    group.add_argument(
+        "--pack-sequences",
+        action="store_true",
+        help="Also write a best-fit packed sample index of fixed --seq-length "
+        "samples next to merged.idx. Megatron's GPTDataset does not read it, "
+        "load it with PackedDataset.",
+    )
+    group.add_argument(
+        "--seq-length",
+        type=int,
+        default=None,
+        help="Training sequence length used by --pack-sequences.",
+    )
+    group.add_argument(
+        "--shuffle-merge",
+        action="store_true",
+        help="Write the merged documents in a seeded global permutation instead "
+        "of source file order.",
+    )
+    group.add_argument(
+        "--shuffle-seed", type=int, default=1234, help="Seed of the merge permutation."
+    )
+    group.add_argument(
+        "--shuffle-buffer-mb",
+        type=int,
+        default=4096,
+        help="Approximate RAM used by the external-memory shuffle. The merged "
+        "tokens are spilled to buckets of about this size.",
+    )
+    group = parser.add_argument_group(title="runtime")
+    group.add_argument(
+        "--workers",
+        type=int,
+        required=True,
+        help=(
+            "Number of worker processes to launch."
+            "A good default for fast pre-processing "
+            "is: (workers * partitions) = available CPU cores."
+        ),
+    )
+    group.add_argument(
+        "--partitions", type=int, default=1, help="Number of file partitions"
+    )
+    group.add_argument(
+        "--log-interval", type=int, default=1000, help="Interval between progress updates"
+    )
+    group.add_argument(
+        "--keep-sequential-samples",
+        action="store_true",
+        help="Ensure ordering of samples in .jsonl files is "
+        "preserved when using partitions>1.",
+    )
+    group.add_argument(
+        "--memory-budget-gb",
+        type=float,
+        default=None,
+        help="Memory available to concurrently running tasks. Defaults to the "
+        "memory resource of the Ray cluster.",
+    )
+    group.add_argument(
+        "--task-memory-base-gb",
+        type=float,
+        default=4.0,
+        help="Initial estimate of a task's memory independent of its input size "
+        "(tokenizers, worker pool), refined from measured tasks.",
+    )
+    group.add_argument(
+        "--task-memory-per-doc-kb",
+        type=float,
+        default=1.0,
+        help="Initial estimate of a task's memory per input document, refined "
+        "from measured tasks.",
+    )
+    group.add_argument(
+        "--line-index-dir",
+        type=str,
+        default=None,
+        help="Directory for the .lines.npy newline offset sidecars of the inputs, "
+        "if they cannot be written next to the inputs.",
+    )
+    group.add_argument(
+        "--scratch-dir",
+        type=str,
+        default=None,
+        help="Node-local directory (e.g. local SSD or /dev/shm) to stage inputs "
+        "and per-file outputs in. Only the merged files are written to the "
+        "output directory. Staged per-file outputs are not kept for resuming.",
+    )
+    group.add_argument(
+        "--task-retries",
+        type=int,
+        default=2,
+        help="Retries of a task after a worker crash or an I/O error before its "
+        "input is quarantined.",
+    )
+    group.add_argument(
+        "--max-error-rate",
+        type=float,
+        default=0.01,
+        help="Fraction of malformed lines (invalid JSON, missing or non-text "
+        "--json-keys) an input may have; malformed lines are skipped and "
+        "counted, inputs with more are quarantined.",
+    )
+    group.add_argument(
+        "--retry-quarantined",
+        action="store_true",
+        help="Process inputs again that were quarantined by an earlier run.",
+    )
+    group.add_argument(
+        "--read-queue-depth",
+        type=int,
+        default=16,
+        help="Blocks of ~4 MB of input lines read and decompressed ahead of the "
+        "encoders by a background thread.",
+    )
+    group.add_argument(
+        "--write-queue-depth",
+        type=int,
+        default=64,
+        help="Batches of encoded documents buffered for the background thread "
+        "writing the .bin files.",
+    )
+    group.add_argument(
+        "--encode-batch-size",
+        type=int,
+        default=32,
+        help="Input lines per work item sent to an encoder process.",
+    )
+    group = parser.add_argument_group(title="dry run")
+    group.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only tokenize a sample of the inputs and log the estimated tokens, "
+        "output sizes, peak memory and wall time of the full run.",
+    )
+    group.add_argument(
+        "--dry-run-fraction",
+        type=float,
+        default=0.001,
+        help="Fraction of the documents of each input to sample.",
+    )
+    group.add_argument(
+        "--dry-run-max-docs",
+        type=int,
+        default=20000,
+        help="Upper bound on the sampled documents of all inputs together, "
+        "split across inputs by size.",
+    )
+    group.add_argument(
+        "--dry-run-seconds",
+        type=float,
+        default=60,
+        help="Stop sampling further inputs after this many seconds; unsampled "
+        "inputs are estimated from the average of the sampled ones.",
+    )
+    group.add_argument(
+        "--dry-run-cpus",
+        type=int,
+        default=os.cpu_count(),
+        help="CPUs of the Ray cluster to estimate the wall time for.",
+    )
+    group = parser.add_argument_group(title="autotune")
+    group.add_argument(
+        "--autotune",
+        action="store_true",
+        help="Choose --workers, --partitions, --cpus-per-ray-worker and "
+        "--encode-batch-size from short calibration passes on the first inputs "
+        "and record the choice in <output-prefix>/autotune.json. Later runs on "
+        "the same cluster shape and tokenizers reuse the recorded choice.",
+    )
+    group.add_argument(
+        "--autotune-refresh",
+        action="store_true",
+        help="Calibrate again even if a matching autotune.json exists.",
+    )
+    group.add_argument(
+        "--autotune-inputs",
+        type=int,
+        default=3,
+        help="Number of inputs (the largest ones) whose first lines form the "
+        "calibration sample.",
+    )
+    group.add_argument(
+        "--autotune-sample-mb",
+        type=float,
+        default=4,
+        help="Calibration input per encoder worker, so every pass takes about "
+        "the same time whatever the configuration.",
+    )
+    group = parser.add_argument_group(title="deduplication")
+    group.add_argument(
+        "--dedup",
+        type=str,
+        default="none",
+        choices=["none", "exact", "near"],
+        help="Drop duplicate documents before encoding. 'exact' hashes the document "
+        "text, 'near' additionally drops near duplicates found with MinHash-LSH.",
+    )
+    group.add_argument(
+        "--dedup-shards",
+        type=int,
+        default=8,
+        help="Number of Ray actors the dedup hash state is sharded across.",
+    )
+    group.add_argument(
+        "--minhash-num-perm",
+        type=int,
+        default=128,
+        help="Number of MinHash permutations per document.",
+    )
+    group.add_argument(
+        "--minhash-bands",
+        type=int,
+        default=16,
+        help="Number of LSH bands. With b bands of r rows the Jaccard similarity "
+        "threshold is roughly (1/b)^(1/r), ~0.7 for the defaults.",
+    )
+    group.add_argument(
+        "--minhash-ngram",
+        type=int,
+        default=5,
+        help="Size of the word n-grams (shingles) hashed by MinHash.",
+    )
+
+    args = parser.parse_args(argv)
+
+    if args.pack_sequences and (args.seq_length is None or args.split_sentences):
+        parser.error("--pack-sequences requires --seq-length and document-level data")
+    if len(args.input) != len(args.output_prefix):
+        parser.error("--input and --output-prefix need the same number of directories")
+    if args.workers % args.partitions != 0:
+        parser.error("--workers must be a multiple of --partitions")
+    for spec in args.filter:
+        try:
+            parse_filter(spec)
+        except ValueError as e:
+            parser.error(str(e))
+
+    return args
+
+
+# input file extensions picked up in --input directories; non-jsonl inputs are
+# converted with `convert_to_jsonl`
+INPUT_FORMATS = {".jsonl": "jsonl", ".parquet": "parquet", ".arrow": "arrow"}
+
+# MinHash permutations are (a * h + b) mod p, truncated to 32 bits
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def preprocess_data(args, keep=None):
+    """Tokenize `args.input` into `args.output_prefix` .bin/.idx files.
+
+    With several partitions, the partition inputs and outputs are written to
+    <output_prefix>_partitions/ and removed once combined, or on failure.
+
+    `keep` optionally holds one flag per input line; lines flagged False
+    (e.g. duplicates found by `find_duplicates`) are dropped before encoding.
+
+    Returns the line and document counts of `process_json_file` summed over
+    all partitions (and the longest partition startup time), and raises if
+    any partition process fails.
+    """
+    from megatron.training.tokenizer import build_tokenizer
+    from megatron.core.datasets import indexed_dataset
+
+    if args.split_sentences:
+        try:
+            import nltk
+        except ImportError:
+            raise Exception(
+                "nltk library required for sentence splitting is not available."
+            )
+        nltk.download("punkt", quiet=True, download_dir=os.environ.get("NLTK_DATA"))
+
+    partition_dir = args.output_prefix + "_partitions"
+    shutil.rmtree(partition_dir, ignore_errors=True)
+    try:
+        in_ss_out_names = []
+        if args.partitions == 1:
+            file_names = {
+                "partition": args.input,
+                "output_prefix": args.output_prefix,
+            }
+            in_ss_out_names.append(file_names)
+        else:
+            # partition inputs and outputs live next to the output, never in the
+            # input directory, and are written anew by every attempt
+            os.makedirs(partition_dir)
+            in_file_names = glob.glob(args.input)
+
+            # Count total number of lines across .jsonl files
+            if args.keep_sequential_samples:
+                if keep is not None:
+                    total_sample_count = sum(keep)
+                else:
+                    total_sample_count = sum(
+                        count_lines(filename, args.line_index_dir) for filename in in_file_names
+                    )
+                partition_size = math.ceil(total_sample_count / args.partitions)
+
+            # create .jsonl parition files
+            for idx in range(args.partitions):
+                in_ss_out_names.append(
+                    {
+                        "partition": os.path.join(partition_dir, f"partition_{idx}.jsonl"),
+                        "output_prefix": os.path.join(partition_dir, f"partition_{idx}"),
+                    }
+                )
+
+            # sequential partitions of plain files are contiguous byte ranges
+            byte_ranges = (
+                args.keep_sequential_samples
+                and keep is None
+                and not any(name.endswith(".gz") for name in in_file_names)
+            )
+
+            if byte_ranges:
+                # populate .jsonl partition files with bulk copies of line ranges
+                partitioned_input_files = [
+                    open(in_ss_out_names[idx]["partition"], "wb") for idx in range(args.partitions)
+                ]
+                first_line = 0
+                for in_file_name in in_file_names:
+                    offsets = load_line_index(in_file_name, args.line_index_dir)
+                    num_lines = len(offsets) - 1
+                    with open(in_file_name, "rb") as fin:
+                        for idx in range(args.partitions):
+                            start = max(idx * partition_size - first_line, 0)
+                            end = min((idx + 1) * partition_size - first_line, num_lines)
+                            if start < end:
+                                copy_byte_range(
+                                    fin, partitioned_input_files[idx], offsets[start], offsets[end]
+                                )
+                    first_line += num_lines
+
+                for idx in range(args.partitions):
+                    partitioned_input_files[idx].close()
+
+            else:
+                # populate .jsonl partition files from parent files
+                partitioned_input_files = []
+                for idx in range(args.partitions):
+                    partitioned_input_file = open(in_ss_out_names[idx]["partition"], "w")
+                    partitioned_input_files.append(partitioned_input_file)
+
+                index = 0
+                if args.keep_sequential_samples:
+                    line_count = 0
+                line_keep = iter(keep) if keep is not None else itertools.repeat(True)
+                for in_file_name in in_file_names:
+                    # support for gzip files
+                    if in_file_name.endswith(".gz"):
+                        fin = gzip.open(in_file_name, "rt")
+                    else:
+                        fin = open(in_file_name, "r", encoding="utf-8")
+
+                    for line in fin:
+                        if not next(line_keep, True):
+                            continue
+                        partitioned_input_files[index].write(line)
+                        if args.keep_sequential_samples:
+                            line_count += 1
+                            if line_count % partition_size == 0:
+                                index += 1
+                        else:
+                            index = (index + 1) % args.partitions
+
+                    fin.close()
+
+                for idx in range(args.partitions):
+                    partitioned_input_files[idx].close()
+
+        assert args.workers % args.partitions == 0
+        workers = args.workers // args.partitions
+        # line index sidecars of partition files stay in the partition directory
+        partition_args = args
+        if args.partitions > 1:
+            partition_args = argparse.Namespace(**dict(vars(args), line_index_dir=None))
+
+        # encode partition files in parallel, sentences are split by the encoding
+        # workers themselves so no intermediate _ss files are written
+        processes = []
+        stats_queue = multiprocessing.Queue()
+        for name in in_ss_out_names:
+            # partition files were already filtered while being populated
+            p = multiprocessing.Process(
+                target=process_json_file,
+                args=(
+                    partition_args,
+                    workers,
+                    name["partition"],
+                    name["output_prefix"],
+                    keep if args.partitions == 1 else None,
+                    stats_queue,
+                ),
+            )
+            p.start()
+            processes.append(p)
+
+        for p in processes:
+            p.join()
+        for name, p in zip(in_ss_out_names, processes):
+            if p.exitcode != 0:
+                raise RuntimeError(f"Encoding {name['partition']} failed with exit code {p.exitcode}")
+        stats = {"lines": 0, "documents": 0, "filtered": 0, "errors": 0, "startup_seconds": 0.0}
+        for _ in processes:
+            for field, count in stats_queue.get().items():
+                # partitions start up concurrently
+                if field == "startup_seconds":
+                    stats[field] = max(stats[field], count)
+                else:
+                    stats[field] += count
+
+        if args.partitions == 1:
+            return stats
+
+        # merge bin/idx partitions
+        level = "document"
+        if args.split_sentences:
+            level = "sentence"
+
+        for tokenizer_args in get_tokenizer_args(args):
+            output_prefix = get_tokenizer_output_prefix(
+                args.output_prefix, tokenizer_args.tokenizer_name
+            )
+            output_bin_files = {}
+            output_idx_files = {}
+            builders = {}
+            tokenizer = build_tokenizer(tokenizer_args)
+
+            for key in args.json_keys:
+                output_bin_files[key] = "{}_{}_{}.bin".format(output_prefix, key, level)
+                output_idx_files[key] = "{}_{}_{}.idx".format(output_prefix, key, level)
+                builders[key] = indexed_dataset.IndexedDatasetBuilder(
+                    output_bin_files[key],
+                    dtype=indexed_dataset.DType.optimal_dtype(tokenizer.vocab_size),
+                )
+
+                for name in in_ss_out_names:
+                    parition_output_prefix = get_tokenizer_output_prefix(
+                        name["output_prefix"], tokenizer_args.tokenizer_name
+                    )
+                    full_partition_output_prefix = "{}_{}_{}".format(
+                        parition_output_prefix, key, level
+                    )
+                    builders[key].add_index(full_partition_output_prefix)
+                builders[key].finalize(output_idx_files[key])
+
+        return stats
+    finally:
+        shutil.rmtree(partition_dir, ignore_errors=True)
+
+
+def parse_tokenizer_spec(spec):
+    """Split a --tokenizers entry "NAME=TYPE:MODEL" into its three parts."""
+    name, sep, rest = spec.partition("=")
+    tokenizer_type, sep2, tokenizer_model = rest.partition(":")
+    if not (sep and sep2 and name and tokenizer_type):
+        raise ValueError(f"Invalid tokenizer spec {spec!r}, expected NAME=TYPE:MODEL")
+    return name, tokenizer_type, tokenizer_model
+
+
+def get_tokenizer_args(args):
+    """
+    Return one argument namespace per tokenizer to encode with.
+
+    Without --tokenizers this is `args` itself (with `tokenizer_name` None);
+    otherwise a copy of `args` per spec with the tokenizer type and model
+    replaced and `tokenizer_name` set.
+    """
+    if not getattr(args, "tokenizers", None):
+        return [argparse.Namespace(**dict(vars(args), tokenizer_name=None))]
+    tokenizer_args = []
+    for spec in args.tokenizers:
+        name, tokenizer_type, tokenizer_model = parse_tokenizer_spec(spec)
+        tokenizer_args.append(
+            argparse.Namespace(
+                **dict(
+                    vars(args),
+                    tokenizer_name=name,
+                    tokenizer_type=tokenizer_type,
+                    tokenizer_model=tokenizer_model,
+                )
+            )
+        )
+    return tokenizer_args
+
+
+def get_tokenizer_output_dir(output_dir, tokenizer_name):
+    """Place the outputs of a named tokenizer in a subdirectory of its own."""
+    if tokenizer_name is None:
+        return output_dir
+    return os.path.join(output_dir, tokenizer_name)
+
+
+def get_tokenizer_output_prefix(output_prefix, tokenizer_name):
+    if tokenizer_name is None:
+        return output_prefix
+    return os.path.join(
+        get_tokenizer_output_dir(os.path.dirname(output_prefix), tokenizer_name),
+        os.path.basename(output_prefix),
+    )
+
+
+_FILTER_OPERATORS = {
+    ">=": operator.ge,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne,
+    ">": operator.gt,
+    "<": operator.lt,
+}
+_FILTER_PATTERN = re.compile(r"^\s*([A-Za-z_][\w.]*)\s*(>=|<=|==|!=|>|<)\s*(.*?)\s*$")
+
+
+def parse_filter(spec):
+    """Split a --filter spec `COLUMN OP VALUE`; VALUE is parsed as JSON, else taken as a string."""
+    match = _FILTER_PATTERN.match(spec)
+    if match is None or not match.group(3):
+        raise ValueError(
+            f"Invalid --filter {spec!r}, expected COLUMN OP VALUE with OP one of "
+            f"{', '.join(_FILTER_OPERATORS)}"
+        )
+    column, op, value = match.groups()
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return column, op, value
+
+
+class RowFilter(object):
+    """
+    Accepts the documents matching every --filter and the --min-chars/--max-chars bounds.
+
+    A document that lacks a filtered column, has a null there or a value that
+    cannot be compared with the filter value is rejected, like a null in
+    Arrow. The length bounds count the characters of all --json-keys.
+    """
+
+    def __init__(self, args):
+        self.json_keys = args.json_keys
+        self.conditions = [parse_filter(spec) for spec in getattr(args, "filter", None) or []]
+        self.min_chars = getattr(args, "min_chars", None)
+        self.max_chars = getattr(args, "max_chars", None)
+
+    def __bool__(self):
+        return bool(self.conditions) or self.min_chars is not None or self.max_chars is not None
+
+    def __call__(self, data):
+        for column, op, value in self.conditions:
+            field = data
+            try:
+                for name in column.split("."):
+                    field = field[name]
+                if field is None or not _FILTER_OPERATORS[op](field, value):
+                    return False
+            except (KeyError, TypeError):
+                return False
+        if self.min_chars is not None or self.max_chars is not None:
+            length = 0
+            for key in self.json_keys:
+                text = data[key]
+                length += len(text) if isinstance(text, str) else sum(len(s) for s in text)
+            if self.min_chars is not None and length < self.min_chars:
+                return False
+            if self.max_chars is not None and length > self.max_chars:
+                return False
+        return True
+
+    def arrow_expression(self):
+        """The filter as a `pyarrow.dataset` expression (None if empty), for Parquet row-group pruning."""
+        import pyarrow.compute as pc
+        import pyarrow.dataset as ds
+
+        terms = [
+            _FILTER_OPERATORS[op](ds.field(*column.split(".")), value)
+            for column, op, value in self.conditions
+        ]
+        if self.min_chars is not None or self.max_chars is not None:
+            lengths = [pc.utf8_length(ds.field(key)) for key in self.json_keys]
+            length = lengths[0]
+            for key_length in lengths[1:]:
+                length = pc.add(length, key_length)
+            if self.min_chars is not None:
+                terms.append(length >= self.min_chars)
+            if self.max_chars is not None:
+                terms.append(length <= self.max_chars)
+        if not terms:
+            return None
+        expression = terms[0]
+        for term in terms[1:]:
+            expression = expression & term
+        return expression
+
+
+class MultiEncoder(object):
+    """
+    Encoder that decodes each json line once and tokenizes it with every tokenizer.
+
+    Wraps Megatron's `Encoder`, whose initializer loads the first tokenizer
+    and, with --split-sentences, the punkt model once per worker; sentences
+    are then split in the same worker that tokenizes them.
+    """
+
+    def __init__(self, args, tokenizer_args):
+        self.args = tokenizer_args[0]
+        self.tokenizer_args = tokenizer_args
+        self.row_filter = RowFilter(args)
+
+    def initializer(self):
+        from megatron.training.tokenizer import build_tokenizer
+        from tools.preprocess_data import Encoder
+
+        Encoder(self.args).initializer()
+        MultiEncoder.splitter = Encoder.splitter
+        MultiEncoder.tokenizers = [Encoder.tokenizer] + [
+            build_tokenizer(args) for args in self.tokenizer_args[1:]
+        ]
+
+    def split_text(self, text):
+        """Split `text` like `Encoder.split`, in slices to bound NLTK's memory use."""
+        max_len = 1000000
+        return [
+            sentence
+            for i in range(0, len(text), max_len)
+            for sentence in MultiEncoder.splitter.tokenize(text[i : i + max_len])
+        ]
+
+    def encode(self, json_line):
+        """
+        Return the ids and sentence lengths per tokenizer of a json line.
+
+        Instead returns None for documents rejected by the row filter, and the
+        error message for malformed lines, which are counted and skipped.
+        """
+        try:
+            data = json.loads(json_line)
+            for key in self.args.json_keys:
+                if not isinstance(data[key], (str, list)):
+                    raise TypeError(f"{key!r} is {type(data[key]).__name__}, not text")
+        except (ValueError, KeyError, TypeError) as e:
+            return f"{type(e).__name__}: {e}", len(json_line)
+        if not self.row_filter(data):
+            return None, len(json_line)
+        if self.args.split_sentences:
+            for key in self.args.json_keys:
+                if not isinstance(data[key], list):
+                    data[key] = self.split_text(data[key])
+        encoded = []
+        for tokenizer in MultiEncoder.tokenizers:
+            ids = {}
+            lens = {}
+            for key in self.args.json_keys:
+                text = data[key]
+                if isinstance(text, list):
+                    sentences = text
+                else:
+                    sentences = [text]
+                doc_ids = []
+                sentence_lens = []
+                for sentence in sentences:
+                    sentence_ids = tokenizer.tokenize(sentence)
+                    if len(sentence_ids) > 0:
+                        doc_ids.extend(sentence_ids)
+                        sentence_lens.append(len(sentence_ids))
+                if len(doc_ids) > 0 and self.args.append_eod:
+                    doc_ids.append(tokenizer.eod)
+                    sentence_lens[-1] += 1
+                ids[key] = doc_ids
+                lens[key] = sentence_lens
+            encoded.append((ids, lens))
+        return encoded, len(json_line)
+
+    def encode_item(self, item):
+        """Encode a work item of `iter_work_items`: a batch of json lines or one long document segment."""
+        if item[0] == "batch":
+            return "batch", [self.encode(json_line) for json_line in item[1]]
+        _, key, text, last, bytes_processed = item
+        ids = [tokenizer.tokenize(text) for tokenizer in MultiEncoder.tokenizers]
+        return "segment", key, ids, last, bytes_processed
+
+
+def find_segment_boundary(text, lo, hi):
+    """
+    Find a cut in text[lo:hi], as far right as possible, that does not change tokenization.
+
+    Byte-level BPE pre-tokenizers (GPT-2, GPT-NeoX, cosmo2, tiktoken-style
+    patterns) always split between a newline preceded and followed by
+    non-whitespace and the following word, and before a single space that
+    starts a word, and BPE never merges across pre-tokens. Returns None if
+    there is no such position.
+    """
+    end = hi
+    while True:
+        p = text.rfind("\n", lo, end)
+        if p <= lo:
+            break
+        if not text[p - 1].isspace() and p + 1 < len(text) and not text[p + 1].isspace():
+            return p + 1
+        end = p
+    end = hi
+    while True:
+        p = text.rfind(" ", lo, end)
+        if p <= lo:
+            break
+        if not text[p - 1].isspace() and p + 1 < len(text) and not text[p + 1].isspace():
+            return p
+        end = p
+    return None
+
+
+def split_long_text(text, segment_chars):
+    """
+    Cut `text` into segments of at most about `segment_chars` characters.
+
+    Cuts are placed with `find_segment_boundary`, so concatenating the
+    segments' token ids reproduces whole-document encoding for byte-level BPE
+    tokenizers that add no special tokens per call. Only when a window has
+    no such boundary (e.g. one multi-megabyte token-free line) is the text cut
+    hard, which can change the tokens of the single pre-token spanning the
+    cut. Tokenizers that prefix every call (e.g. SentencePiece's dummy "▁"
+    prefix or a BOS token) differ by about one token per cut.
+    """
+    segments = []
+    start = 0
+    while len(text) - start > segment_chars:
+        cut = find_segment_boundary(text, start + segment_chars // 2, start + segment_chars)
+        if cut is None:
+            cut = start + segment_chars
+        segments.append(text[start:cut])
+        start = cut
+    segments.append(text[start:])
+    return segments
+
+
+def iter_work_items(args, lines, batch_size=32):
+    """
+    Turn json lines into encoder work items, preserving document order.
+
+    Lines are grouped into ("batch", lines) items. Documents longer than
+    --long-doc-chars are decoded here and yielded as one
+    ("segment", key, text, last, bytes) item per segment, so their segments
+    are encoded in parallel by the pool and stitched back by the reader.
+    """
+    row_filter = RowFilter(args)
+    batch = []
+    for line in lines:
+        if not args.long_doc_chars or len(line) <= args.long_doc_chars:
+            batch.append(line)
+            if len(batch) == batch_size:
+                yield ("batch", batch)
+                batch = []
+            continue
+
+        # filtered out and malformed documents are handled by the encoder
+        try:
+            data = json.loads(line)
+            segmented = row_filter(data) and all(isinstance(data[key], str) for key in args.json_keys)
+        except (ValueError, KeyError, TypeError):
+            segmented = False
+        if not segmented:
+            batch.append(line)
+            continue
+        if batch:
+            yield ("batch", batch)
+            batch = []
+        segments = [
+            (key, segment)
+            for key in args.json_keys
+            for segment in split_long_text(data[key], args.long_doc_segment_chars)
+        ]
+        for i, (key, segment) in enumerate(segments):
+            last = i == len(segments) - 1
+            yield ("segment", key, segment, last, len(line) if last else 0)
+    if batch:
+        yield ("batch", batch)
+
+
+def stitch_segments(args, segment_ids, eods):
+    """Assemble the per-tokenizer, per-key segment ids of one document into encoded form."""
+    encoded = []
+    for tokenizer_ids, eod in zip(segment_ids, eods):
+        ids = {}
+        lens = {}
+        for key in args.json_keys:
+            doc_ids = tokenizer_ids[key]
+            if len(doc_ids) > 0 and args.append_eod:
+                doc_ids.append(eod)
+            ids[key] = doc_ids
+            lens[key] = [len(doc_ids)] if doc_ids else []
+        encoded.append((ids, lens))
+    return encoded
+
+
+def get_line_index_path(path, line_index_dir=None):
+    """Path of the newline offset sidecar of `path`, next to it unless `line_index_dir` is set."""
+    if line_index_dir:
+        return os.path.join(line_index_dir, os.path.basename(path) + ".lines.npy")
+    return path + ".lines.npy"
+
+
+def build_line_index(path, chunk_bytes=256 * 1024 * 1024):
+    """
+    Scan `path` for newlines with a vectorized search over a memory map.
+
+    Returns:
+        int64 array of n_lines + 1 byte offsets: line i is the byte range
+        offsets[i]:offsets[i + 1], and offsets[-1] is the file size
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return np.zeros(1, dtype=np.int64)
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    line_ends = [
+        np.flatnonzero(data[start : start + chunk_bytes] == ord("\n")).astype(np.int64)
+        + start
+        + 1
+        for start in range(0, size, chunk_bytes)
+    ]
+    del data
+    offsets = np.concatenate([np.zeros(1, dtype=np.int64)] + line_ends)
+    if offsets[-1] != size:
+        # last line without a trailing newline
+        offsets = np.append(offsets, size)
+    return offsets
+
+
+def load_line_index(path, line_index_dir=None):
+    """
+    Return the line offsets of `path` (see `build_line_index`).
+
+    The offsets are read from the .lines.npy sidecar if it is newer than
+    `path` and matches its size; otherwise they are rebuilt and the sidecar
+    is (re)written for later stages and runs.
+    """
+    index_path = get_line_index_path(path, line_index_dir)
+    if os.path.isfile(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(path):
+        offsets = np.load(index_path, mmap_mode="r")
+        if len(offsets) and offsets[-1] == os.path.getsize(path):
+            return offsets
+
+    offsets = build_line_index(path)
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(index_path, os.getpid())
+        with open(tmp_path, "wb") as fout:
+            np.save(fout, offsets)
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        logging.warning(f"Could not write line index {index_path}: {e}")
+    return offsets
+
+
+def count_lines(path, line_index_dir=None):
+    """Number of lines (documents) of `path`, from its line index when it is not compressed."""
+    if path.endswith(".gz"):
+        with gzip.open(path, "rt") as fin:
+            return sum(1 for _ in fin)
+    return len(load_line_index(path, line_index_dir)) - 1
+
+
+def read_line(fin, offsets, i):
+    """Random access to line `i` of the binary file object `fin` through its line offsets."""
+    fin.seek(offsets[i])
+    return fin.read(offsets[i + 1] - offsets[i])
+
+
+def read_line_at(fin, offset, buffer_size=64 * 1024):
+    """Return the start offset and bytes of the line of binary file `fin` containing byte `offset`."""
+    start = 0
+    pos = offset
+    while pos > 0:
+        chunk_start = max(0, pos - buffer_size)
+        fin.seek(chunk_start)
+        newline = fin.read(pos - chunk_start).rfind(b"\n")
+        if newline >= 0:
+            start = chunk_start + newline + 1
+            break
+        pos = chunk_start
+    fin.seek(start)
+    return start, fin.readline()
+
+
+def copy_byte_range(fin, fout, start, end, buffer_size=64 * 1024 * 1024):
+    """Copy bytes start:end of `fin` to `fout` in large sequential blocks."""
+    fin.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        block = fin.read(min(buffer_size, remaining))
+        if not block:
+            break
+        fout.write(block)
+        remaining -= len(block)
+
+
+def print_processing_stats(args, count, total, proc_start, total_bytes_processed, queues=None):
+    """
+    Like `Partition.print_processing_stats`, with an ETA from the known document count.
+
+    `queues` maps stage names to their bounded queues, whose fill levels show
+    the bottleneck: a full read queue means encoding is the limit, an empty
+    one reading, and a full write queue writing.
+    """
+    if count % args.log_interval == 0:
+        current = time.time()
+        elapsed = current - proc_start
+        mbs = total_bytes_processed / elapsed / 1024 / 1024
+        eta = (total - count) * elapsed / count
+        depths = ""
+        if queues:
+            depths = ", queued " + ", ".join(
+                f"{name} {q.qsize()}/{q.maxsize}" for name, q in queues.items()
+            )
+        print(
+            f"Processed {count}/{total} documents",
+            f"({count / elapsed} docs/s, {mbs} MB/s, ETA {eta:.0f} s{depths}).",
+            file=sys.stderr,
+        )
+
+
+_QUEUE_END = object()
+
+
+def iter_line_blocks(path, block_bytes=4 * 1024 * 1024):
+    """Yield the lines of `path` (bytes, gzip decompressed) in blocks of about `block_bytes`."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as fin:
+        while True:
+            block = fin.readlines(block_bytes)
+            if not block:
+                break
+            yield block
+
+
+class Prefetcher(object):
+    """Iterates `iterable` on a background thread, running up to `depth` items ahead."""
+
+    def __init__(self, iterable, depth):
+        self.queue = queue.Queue(maxsize=depth)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, args=(iterable,), daemon=True)
+        self.thread.start()
+
+    def _run(self, iterable):
+        try:
+            for item in iterable:
+                self.queue.put(item)
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.queue.put(_QUEUE_END)
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is _QUEUE_END:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield item
+
+
+class BackgroundWriter(object):
+    """Calls `write` on queued items on a background thread; `put` blocks while `depth` items wait."""
+
+    def __init__(self, write, depth):
+        self.write = write
+        self.queue = queue.Queue(maxsize=depth)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is _QUEUE_END:
+                return
+            if self.error is None:
+                try:
+                    self.write(item)
+                except BaseException as e:
+                    self.error = e
+
+    def put(self, item):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(item)
+
+    def close(self):
+        """Wait until every queued item is written, re-raising a failed write."""
+        self.queue.put(_QUEUE_END)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def process_json_file(args, workers, input_file_name, output_prefix, keep=None, stats_queue=None):
+    """
+    Same as `Partition.process_json_file`, but only encodes the lines flagged in
+    `keep` and writes one .bin/.idx set per tokenizer from a single read pass.
+
+    Reading and decompressing, encoding in the worker pool, and writing the
+    .bin files run concurrently: a `Prefetcher` thread reads ahead and a
+    `BackgroundWriter` thread adds the encoded documents to the builders,
+    connected through bounded queues whose depths are logged with progress.
+
+    Malformed lines are skipped. The counts of lines, written, filtered and
+    malformed documents are returned, and also put on `stats_queue` when
+    run as a separate process.
+    """
+    from megatron.training.tokenizer import build_tokenizer
+    from megatron.core.datasets import indexed_dataset
+
+    tokenizer_args = get_tokenizer_args(args)
+    print("Opening", input_file_name)
+    if keep is None:
+        total_docs = count_lines(input_file_name, getattr(args, "line_index_dir", None))
+    else:
+        total_docs = sum(keep)
+
+    startup_start = time.time()
+    encoder = MultiEncoder(args, tokenizer_args)
+    pool = multiprocessing.Pool(workers, initializer=encoder.initializer)
+    # the reader thread starts only after the encoders are forked, so they
+    # never inherit its state (e.g. a lock held mid-read)
+    reader = Prefetcher(
+        iter_line_blocks(input_file_name), getattr(args, "read_queue_depth", 16)
+    )
+    lines = itertools.chain.from_iterable(reader)
+    if keep is not None:
+        lines = itertools.compress(lines, keep)
+    # items are already batched, so chunksize 1 lets segments of one long
+    # document spread over all workers
+    encoded_items = pool.imap(
+        encoder.encode_item,
+        iter_work_items(args, lines, getattr(args, "encode_batch_size", 32)),
+        1,
+    )
+
+    level = "document"
+    if args.split_sentences:
+        level = "sentence"
+
+    output_idx_files = []
+    builders = []
+    eods = []
+
+    for t_args in tokenizer_args:
+        tokenizer = build_tokenizer(t_args)
+        eods.append(tokenizer.eod)
+        prefix = get_tokenizer_output_prefix(output_prefix, t_args.tokenizer_name)
+        os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+        output_idx_files.append({})
+        builders.append({})
+        for key in args.json_keys:
+            output_bin_file = "{}_{}_{}.bin".format(prefix, key, level)
+            output_idx_files[-1][key] = "{}_{}_{}.idx".format(prefix, key, level)
+            builders[-1][key] = indexed_dataset.IndexedDatasetBuilder(
+                output_bin_file,
+                dtype=indexed_dataset.DType.optimal_dtype(tokenizer.vocab_size),
+            )
+
+    def write_documents(encoded_docs):
+        for encoded, _ in encoded_docs:
+            if encoded is None or isinstance(encoded, str):
+                continue
+            for tokenizer_builders, (doc, sentence_lens) in zip(builders, encoded):
+                for key in doc.keys():
+                    tokenizer_builders[key].add_document(doc[key], sentence_lens[key])
+
+    writer = BackgroundWriter(write_documents, getattr(args, "write_queue_depth", 64))
+    queues = {"read": reader.queue, "write": writer.queue}
+
+    startup_end = time.time()
+    proc_start = time.time()
+    total_bytes_processed = 0
+    print("Time to startup:", startup_end - startup_start)
+    i = 0
+    filtered = 0
+    errors = 0
+    segment_ids = None
+    for item in encoded_items:
+        if item[0] == "batch":
+            encoded_docs = item[1]
+        else:
+            _, key, ids, last, bytes_processed = item
+            if segment_ids is None:
+                segment_ids = [{k: [] for k in args.json_keys} for _ in tokenizer_args]
+            for tokenizer_ids, ids_ in zip(segment_ids, ids):
+                tokenizer_ids[key].extend(ids_)
+            if not last:
+                continue
+            encoded_docs = [(stitch_segments(args, segment_ids, eods), bytes_processed)]
+            segment_ids = None
+
+        writer.put(encoded_docs)
+        for encoded, bytes_processed in encoded_docs:
+            i += 1
+            total_bytes_processed += bytes_processed
+            if encoded is None:
+                filtered += 1
+            elif isinstance(encoded, str):
+                errors += 1
+                if errors <= 10:
+                    print(f"Skipping malformed line {i} of {input_file_name}: {encoded}", file=sys.stderr)
+            print_processing_stats(args, i, total_docs, proc_start, total_bytes_processed, queues)
+
+    pool.close()
+    pool.join()
+    writer.close()
+    if encoder.row_filter:
+        print(f"Filtered out {filtered} of {i} documents", file=sys.stderr)
+    if errors:
+        print(f"Skipped {errors} malformed lines of {i}", file=sys.stderr)
+    for tokenizer_builders, tokenizer_idx_files in zip(builders, output_idx_files):
+        for key in args.json_keys:
+            tokenizer_builders[key].finalize(tokenizer_idx_files[key])
+
+    stats = {
+        "lines": i,
+        "documents": i - filtered - errors,
+        "filtered": filtered,
+        "errors": errors,
+        "startup_seconds": startup_end - startup_start,
+    }
+    if stats_queue is not None:
+        stats_queue.put(stats)
+    return stats
+
+
+def _hash64(data):
+    """Stable 64-bit hash of `data` (Python's `hash` is salted per process)."""
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+
+class DocumentHasher(object):
+    """Computes the dedup keys of a json line.
+
+    The first key is an exact hash of the document text. For near dedup it is
+    followed by one key per LSH band of the document's MinHash signature, so
+    two documents sharing any key are (near) duplicates.
+    """
+
+    def __init__(self, args):
+        assert args.minhash_num_perm % args.minhash_bands == 0
+        self.json_keys = args.json_keys
+        self.near = args.dedup == "near"
+        self.ngram = args.minhash_ngram
+        self.bands = args.minhash_bands
+        self.rows = args.minhash_num_perm // args.minhash_bands
+        self.row_filter = RowFilter(args)
+        # fixed seed: every worker has to use the same permutations
+        gen = np.random.RandomState(1)
+        self.a = gen.randint(1, _MERSENNE_PRIME, size=args.minhash_num_perm, dtype=np.uint64)
+        self.b = gen.randint(0, _MERSENNE_PRIME, size=args.minhash_num_perm, dtype=np.uint64)
+
+    def signature(self, text):
+        words = text.split()
+        shingles = {
+            " ".join(words[i : i + self.ngram])
+            for i in range(max(1, len(words) - self.ngram + 1))
+        }
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode("utf-8")) for shingle in shingles),
+            dtype=np.uint64,
+            count=len(shingles),
+        )
+        signature = np.full(self.a.shape, _MAX_HASH, dtype=np.uint64)
+        # bound the (shingles x permutations) matrix for very long documents
+        for start in range(0, len(hashes), 4096):
+            chunk = hashes[start : start + 4096, None]
+            permuted = ((chunk * self.a + self.b) % _MERSENNE_PRIME) & _MAX_HASH
+            np.minimum(signature, permuted.min(axis=0), out=signature)
+        return signature
+
+    def hash_line(self, json_line):
+        """
+        Return the dedup keys of a json line, or None if it is filtered out.
+
+        Malformed lines get no keys, so they are kept and reported by the encoder.
+        """
+        try:
+            data = json.loads(json_line)
+            if not self.row_filter(data):
+                return None
+            text = "\n".join(str(data[key]) for key in self.json_keys)
+        except (ValueError, KeyError, TypeError):
+            return []
+        keys = [_hash64(text.encode("utf-8"))]
+        if self.near:
+            signature = self.signature(text)
+            for band in range(self.bands):
+                rows = signature[band * self.rows : (band + 1) * self.rows]
+                keys.append(_hash64(bytes([band]) + rows.tobytes()))
+        return keys
+
+
+class DedupShard(object):
+    """
+    Holds the dedup keys whose hash falls into this shard, run as a Ray actor.
+
+    Every key remembers the document that registered it first, so a retried
+    task does not find its own documents as duplicates. Keys and documents
+    are kept as uint64 arrays in sorted runs of doubling size (16 bytes per
+    key): every batch adds one run, and runs of similar size are merged.
+    """
+
+    def __init__(self):
+        self.runs = []
+
+    def lookup(self, keys):
+        """Return the registering document of every key, and whether it was found."""
+        documents = np.zeros(len(keys), dtype=np.uint64)
+        found = np.zeros(len(keys), dtype=bool)
+        for run_keys, run_documents in self.runs:
+            positions = np.searchsorted(run_keys, keys)
+            positions[positions == len(run_keys)] = 0
+            hits = run_keys[positions] == keys
+            documents[hits] = run_documents[positions[hits]]
+            found |= hits
+        return documents, found
+
+    def add_run(self, keys, documents):
+        self.runs.append((keys, documents))
+        while len(self.runs) > 1 and len(self.runs[-2][0]) <= 2 * len(self.runs[-1][0]):
+            (keys_a, documents_a), (keys_b, documents_b) = self.runs[-2:]
+            keys = np.concatenate([keys_a, keys_b])
+            order = np.argsort(keys, kind="stable")
+            self.runs[-2:] = [(keys[order], np.concatenate([documents_a, documents_b])[order])]
+
+    def check_and_add(self, keys, documents):
+        """Return for every key whether another document registered it before, then record it."""
+        keys = np.asarray(keys, dtype=np.uint64)
+        documents = np.asarray(documents, dtype=np.uint64)
+        first_documents, found = self.lookup(keys)
+        # keys new to the shard are registered by their first document in the batch
+        new_keys, first, inverse = np.unique(keys[~found], return_index=True, return_inverse=True)
+        new_documents = documents[~found][first]
+        first_documents[~found] = new_documents[inverse.reshape(-1)]
+        if len(new_keys):
+            self.add_run(new_keys, new_documents)
+        return (first_documents != documents).tolist()
+
+    def remove_owner(self, owner):
+        """Forget the keys registered by documents of input `owner`, e.g. once it is quarantined."""
+        runs = []
+        for keys, documents in self.runs:
+            keep = (documents >> np.uint64(32)) != owner
+            if keep.any():
+                runs.append((keys[keep], documents[keep]))
+        self.runs = runs
+
+
+def get_dedup_owner(path):
+    """32-bit id of an input file for `find_duplicates` and `DedupShard.remove_owner`."""
+    return zlib.crc32(path.encode("utf-8"))
+
+
+def find_duplicates(args, dedup_shards, batch_size=8192, owner=0):
+    """
+    Flag the lines of `args.input` that duplicate a document seen earlier by any task.
+
+    Keys are routed to `dedup_shards` by value, so every shard sees all
+    occurrences of its keys and the first document to register a key wins.
+    Keys are registered while checking, so concurrent tasks never both keep a
+    document; `run` removes the keys of inputs that end up quarantined.
+
+    Args:
+        args: Per-file preprocessing arguments
+        dedup_shards: List of `DedupShard` actor handles shared by all tasks
+        batch_size: Number of documents whose keys are sent to the shards at once
+        owner: 32-bit id of the input file, identifying its documents across retries
+            (with the line number in the low 32 bits)
+
+    Returns:
+        Tuple of (keep flags per input line, dedup statistics dict)
+    """
+    import ray
+
+    hasher = DocumentHasher(args)
+    num_shards = len(dedup_shards)
+    keep = []
+    exact_duplicates = 0
+    near_duplicates = 0
+    filtered = 0
+
+    with open(args.input, "r", encoding="utf-8") as fin, multiprocessing.Pool(
+        args.workers
+    ) as pool:
+        doc_keys = pool.imap(hasher.hash_line, fin, 32)
+        while True:
+            batch = list(itertools.islice(doc_keys, batch_size))
+            if not batch:
+                break
+
+            shard_keys = [[] for _ in range(num_shards)]
+            shard_docs = [[] for _ in range(num_shards)]
+            for doc, keys in enumerate(batch):
+                for i, key in enumerate(keys or ()):
+                    shard = key % num_shards
+                    shard_keys[shard].append(key)
+                    shard_docs[shard].append((doc, i == 0))
+            results = ray.get(
+                [
+                    shard.check_and_add.remote(
+                        keys, [(owner << 32) + len(keep) + doc for doc, _ in docs]
+                    )
+                    for shard, keys, docs in zip(dedup_shards, shard_keys, shard_docs)
+                ]
+            )
+
+            is_exact = [False] * len(batch)
+            is_near = [False] * len(batch)
+            for docs, present in zip(shard_docs, results):
+                for (doc, exact_key), seen in zip(docs, present):
+                    if seen and exact_key:
+                        is_exact[doc] = True
+                    elif seen:
+                        is_near[doc] = True
+
+            # filtered out documents are dropped without registering their keys
+            for keys, exact, near in zip(batch, is_exact, is_near):
+                if keys is None:
+                    filtered += 1
+                elif exact:
+                    exact_duplicates += 1
+                elif near:
+                    near_duplicates += 1
+                keep.append(not (keys is None or exact or near))
+
+    stats = {
+        "input": args.input,
+        "documents": len(keep),
+        "exact_duplicates": exact_duplicates,
+        "near_duplicates": near_duplicates,
+        "filtered": filtered,
+        "kept": len(keep) - exact_duplicates - near_duplicates - filtered,
+    }
+    return keep, stats
+
+
+def report_dedup_stats(all_stats, report_file):
+    """Log the dedup ratio of every input and write the stats as jsonl."""
+    total_documents = 0
+    total_kept = 0
+    with open(report_file, "w") as fout:
+        for stats in all_stats:
+            fout.write(json.dumps(stats) + "\n")
+            total_documents += stats["documents"]
+            total_kept += stats["kept"]
+            removed = 1 - stats["kept"] / stats["documents"] if stats["documents"] else 0.0
+            logging.info(
+                f"Dedup {os.path.basename(stats['input'])}: kept {stats['kept']}/{stats['documents']} "
+                f"documents ({removed:.2%} removed, {stats['exact_duplicates']} exact, "
+                f"{stats['near_duplicates']} near duplicates, {stats.get('filtered', 0)} filtered)"
+            )
+    if total_documents:
+        logging.info(
+            f"Dedup total: kept {total_kept}/{total_documents} documents "
+            f"({1 - total_kept / total_documents:.2%} removed)"
+        )
+
+
+def merge_datasets(args):
+    from megatron.core.datasets.indexed_dataset import (
+        IndexedDataset,
+        IndexedDatasetBuilder,
+        get_bin_path,
+        get_idx_path,
+    )
+
+    prefixes = set()
+    for basename in os.listdir(args.input):
+        prefix, ext = os.path.splitext(basename)
+
+        if prefix in prefixes or ext not in (".bin", ".idx"):
+            continue
+
+        if not os.path.isfile(os.path.join(args.input, basename)):
+            continue
+
+        # the .idx is written last, so a .bin without it is an interrupted output
+        if ext == ".bin" and not os.path.isfile(os.path.join(args.input, prefix) + ".idx"):
+            logging.warning(f"Skipping incomplete output {os.path.join(args.input, basename)}")
+            continue
+
+        ext_pair = ".bin" if ext == ".idx" else ".idx"
+        assert os.path.isfile(
+            os.path.join(args.input, prefix) + ext_pair
+        ), f"ERROR: {ext_pair} file not provided for {os.path.join(args.input, prefix)}"
+
+        prefixes.add(prefix)
+
+    # the merge is written under a temporary prefix and renamed into place, so
+    # subsets hard-linked to an earlier merged .bin keep reading their tokens
+    output_prefix = args.output_prefix
+    args = argparse.Namespace(**dict(vars(args), output_prefix=output_prefix + "_partial"))
+    if getattr(args, "shuffle", False):
+        merge_datasets_shuffled(
+            args, [os.path.join(args.input, prefix) for prefix in sorted(prefixes)]
+        )
+        replace_dataset(args.output_prefix, output_prefix)
+        return
+
+    names, sources = concat_document_sources(
+        [os.path.join(args.input, prefix) for prefix in sorted(prefixes)]
+    )
+
+    builder = None
+    for prefix in sorted(prefixes):
+        if builder is None:
+            dataset = IndexedDataset(
+                os.path.join(args.input, prefix), multimodal=args.multimodal
+            )
+            builder = IndexedDatasetBuilder(
+                get_bin_path(args.output_prefix),
+                dtype=dataset.index.dtype,
+                multimodal=args.multimodal,
+            )
+            del dataset
+
+        builder.add_index(os.path.join(args.input, prefix))
+
+    builder.finalize(get_idx_path(args.output_prefix))
+    write_document_sources(args.output_prefix, names, sources)
+    replace_dataset(args.output_prefix, output_prefix)
+
+
+def replace_dataset(path_prefix, output_prefix):
+    """Rename the .bin, .idx and provenance files of `path_prefix` to `output_prefix`."""
+    from megatron.core.datasets.indexed_dataset import get_bin_path, get_idx_path
+
+    paths = zip(
+        (get_bin_path(path_prefix), get_idx_path(path_prefix)) + get_source_paths(path_prefix),
+        (get_bin_path(output_prefix), get_idx_path(output_prefix)) + get_source_paths(output_prefix),
+    )
+    for path, output_path in paths:
+        if os.path.isfile(path):
+            os.replace(path, output_path)
+
+
+def get_source_paths(path_prefix):
+    """Paths of the per-document source id array and the source name list of a dataset."""
+    return path_prefix + "_sources.npy", path_prefix + "_sources.json"
+
+
+def load_document_sources(path_prefix):
+    """
+    Return the source names and per-document source ids of a dataset.
+
+    A dataset without source files, such as the output of a single input
+    file, is one source named after its prefix.
+    """
+    from megatron.core.datasets.indexed_dataset import IndexedDataset
+
+    ids_path, names_path = get_source_paths(path_prefix)
+    if os.path.isfile(ids_path) and os.path.isfile(names_path):
+        with open(names_path, "r") as f:
+            names = json.load(f)
+        return names, np.load(ids_path)
+    num_documents = len(IndexedDataset(path_prefix).index.document_indices) - 1
+    return [os.path.basename(path_prefix)], np.zeros(num_documents, dtype=np.uint16)
+
+
+def concat_document_sources(path_prefixes):
+    """Source names and per-document source ids of `path_prefixes` concatenated in order."""
+    names = []
+    ids = [np.zeros(0, dtype=np.uint32)]
+    for prefix in path_prefixes:
+        prefix_names, prefix_ids = load_document_sources(prefix)
+        ids.append(prefix_ids.astype(np.uint32) + len(names))
+        names.extend(prefix_names)
+    return names, np.concatenate(ids)
+
+
+def get_source_dtype(num_sources):
+    """Smallest dtype of the per-document source ids of `num_sources` sources."""
+    return np.uint16 if num_sources <= np.iinfo(np.uint16).max + 1 else np.uint32
+
+
+def write_document_sources(path_prefix, names, ids):
+    """Write the provenance files of a dataset: one source id per document and the source names."""
+    ids_path, names_path = get_source_paths(path_prefix)
+    np.save(ids_path, np.asarray(ids).astype(get_source_dtype(len(names))))
+    with open(names_path, "w") as f:
+        json.dump(names, f)
+
+
+def gather_sequences(document_indices, documents):
+    """Return the sequence indices of `documents`, in order, and the document indices of the subset."""
+    starts = document_indices[documents]
+    counts = document_indices[documents + 1] - starts
+    subset_document_indices = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    offsets = np.arange(subset_document_indices[-1]) - np.repeat(subset_document_indices[:-1], counts)
+    return np.repeat(starts, counts) + offsets, subset_document_indices
+
+
+def write_index(idx_path, dtype, sequence_lengths, sequence_pointers, document_indices):
+    """
+    Write a Megatron .idx file with explicit sequence pointers.
+
+    `IndexedDatasetBuilder` always derives the pointers from the lengths, so
+    it cannot describe documents that stay at their offsets in another .bin.
+    """
+    from megatron.core.datasets.indexed_dataset import _INDEX_HEADER, DType
+
+    with open(idx_path, "wb") as f:
+        f.write(_INDEX_HEADER)
+        f.write(struct.pack("<Q", 1))
+        f.write(struct.pack("<B", DType.code_from_dtype(dtype)))
+        f.write(struct.pack("<Q", len(sequence_lengths)))
+        f.write(struct.pack("<Q", len(document_indices)))
+        f.write(np.asarray(sequence_lengths, dtype=np.int32).tobytes(order="C"))
+        f.write(np.asarray(sequence_pointers, dtype=np.int64).tobytes(order="C"))
+        f.write(np.asarray(document_indices, dtype=np.int64).tobytes(order="C"))
+
+
+def build_subset(path_prefix, output_prefix, documents, copy=False):
+    """
+    Write the dataset made of `documents` of `path_prefix` to `output_prefix`.
+
+    Without `copy` the .bin is a hard link to the input .bin and only the
+    .idx is written. Merges replace their output instead of rewriting it, so
+    the link keeps the tokens the .idx points to even after the input is
+    rebuilt. On another filesystem, or with `copy`, the documents are copied
+    in maximal runs of adjacent bytes, so a contiguous selection is a single
+    sequential copy.
+
+    Returns:
+        Number of tokens in the subset
+    """
+    from megatron.core.datasets.indexed_dataset import IndexedDataset, get_bin_path, get_idx_path
+
+    index = IndexedDataset(path_prefix).index
+    dtype = index.dtype
+    sequences, document_indices = gather_sequences(np.asarray(index.document_indices), documents)
+    sequence_lengths = np.asarray(index.sequence_lengths)[sequences]
+    sequence_pointers = np.asarray(index.sequence_pointers)[sequences]
+
+    bin_path = get_bin_path(output_prefix)
+    if os.path.lexists(bin_path):
+        os.remove(bin_path)
+    if not copy:
+        try:
+            os.link(os.path.realpath(get_bin_path(path_prefix)), bin_path)
+        except OSError as e:
+            logging.warning(f"Cannot hard-link {get_bin_path(path_prefix)} ({e}), copying instead")
+            copy = True
+    if copy:
+        sequence_bytes = sequence_lengths.astype(np.int64) * np.dtype(dtype).itemsize
+        ends = sequence_pointers + sequence_bytes
+        breaks = np.flatnonzero(sequence_pointers[1:] != ends[:-1]) + 1
+        run_starts = sequence_pointers[np.concatenate([[0], breaks])] if len(sequences) else []
+        run_ends = ends[np.concatenate([breaks - 1, [len(sequences) - 1]])] if len(sequences) else []
+        with open(get_bin_path(path_prefix), "rb") as fin, open(bin_path, "wb") as fout:
+            for start, end in zip(run_starts, run_ends):
+                copy_byte_range(fin, fout, int(start), int(end))
+        logging.info(f"Copied {len(run_starts)} runs of documents")
+        # one pointer per sequence, also for an empty selection
+        sequence_pointers = np.concatenate([[0], np.cumsum(sequence_bytes)])[:-1].astype(np.int64)
+
+    write_index(get_idx_path(output_prefix), dtype, sequence_lengths, sequence_pointers, document_indices)
+    return int(sequence_lengths.sum())
+
+
+def iter_document_chunks(path_prefix, chunk_bytes):
+    """
+    Read the documents of an indexed dataset in contiguous chunks.
+
+    Yields:
+        Tuples of (tokens, token_starts, sequence_lengths, document_indices) for
+        roughly `chunk_bytes` of consecutive documents. Document i of a chunk is
+        tokens[token_starts[i]:token_starts[i + 1]], made of the sequences
+        sequence_lengths[document_indices[i]:document_indices[i + 1]].
+    """
+    from megatron.core.datasets.indexed_dataset import IndexedDataset, get_bin_path
+
+    dataset = IndexedDataset(path_prefix)
+    dtype = dataset.index.dtype
+    sequence_lengths = np.array(dataset.index.sequence_lengths)
+    sequence_pointers = np.array(dataset.index.sequence_pointers)
+    document_indices = np.array(dataset.index.document_indices)
+    del dataset
+
+    itemsize = np.dtype(dtype).itemsize
+    total_tokens = int(sequence_lengths.sum())
+    # an empty .bin cannot be memory-mapped, its documents are all empty
+    if total_tokens:
+        bin_tokens = np.memmap(get_bin_path(path_prefix), dtype=dtype, mode="r")
+    else:
+        bin_tokens = np.zeros(0, dtype=dtype)
+    sequence_starts = np.append(sequence_pointers // itemsize, total_tokens)
+    document_starts = sequence_starts[document_indices]
+    num_documents = len(document_indices) - 1
+    chunk_tokens = max(chunk_bytes // itemsize, 1)
+
+    first = 0
+    while first < num_documents:
+        last = np.searchsorted(
+            document_starts, document_starts[first] + chunk_tokens, side="right"
+        ) - 1
+        last = min(max(last, first + 1), num_documents)
+        tokens = np.array(bin_tokens[document_starts[first] : document_starts[last]])
+        yield (
+            tokens,
+            document_starts[first : last + 1] - document_starts[first],
+            sequence_lengths[document_indices[first] : document_indices[last]],
+            document_indices[first : last + 1] - document_indices[first],
+        )
+        first = last
+
+
+def merge_datasets_shuffled(args, path_prefixes):
+    """
+    Merge `path_prefixes` in a seeded global permutation of their documents.
+
+    External-memory shuffle: every document is scattered to a random bucket
+    with sequential chunked reads, then each bucket (about
+    `args.shuffle_buffer_mb` large) is loaded, permuted in RAM and appended to
+    the output. This yields a uniform permutation determined by the seed and
+    the sorted inputs.
+    """
+    from megatron.core.datasets.indexed_dataset import (
+        IndexedDataset,
+        IndexedDatasetBuilder,
+        get_bin_path,
+        get_idx_path,
+    )
+
+    assert not args.multimodal, "shuffled merge does not support multimodal datasets"
+    buffer_bytes = args.shuffle_buffer_mb * 1024 * 1024
+    total_bytes = sum(os.path.getsize(get_bin_path(prefix)) for prefix in path_prefixes)
+    # headroom since random bucket sizes fluctuate around the mean
+    num_buckets = max(1, math.ceil(1.25 * total_bytes / buffer_bytes))
+
+    # every bucket keeps its .bin and its source ids open
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if 2 * num_buckets + 64 > soft_limit:
+        resource.setrlimit(
+            resource.RLIMIT_NOFILE, (min(2 * num_buckets + 64, hard_limit), hard_limit)
+        )
+        if 2 * num_buckets + 64 > hard_limit:
+            num_buckets = (hard_limit - 64) // 2
+            logging.warning(
+                f"Open file limit caps the shuffle at {num_buckets} buckets, "
+                f"buckets will exceed --shuffle-buffer-mb"
+            )
+
+    dtype = IndexedDataset(path_prefixes[0]).index.dtype
+    bucket_dir = args.output_prefix + "_shuffle_buckets"
+    os.makedirs(bucket_dir, exist_ok=True)
+    bucket_prefixes = [
+        os.path.join(bucket_dir, "bucket_{:05d}".format(bucket))
+        for bucket in range(num_buckets)
+    ]
+    bucket_builders = [
+        IndexedDatasetBuilder(get_bin_path(prefix), dtype=dtype)
+        for prefix in bucket_prefixes
+    ]
+    # the source id of every document is spilled to its bucket in scatter
+    # order and permuted along with it, so no per-document array is kept
+    bucket_source_files = [open(prefix + "_sources.u32", "wb") for prefix in bucket_prefixes]
+    bucket_counts = [0] * num_buckets
+    rng = np.random.default_rng(args.shuffle_seed)
+    names = []
+
+    logging.info(f"Scattering {len(path_prefixes)} datasets into {num_buckets} buckets")
+    chunk_bytes = min(64 * 1024 * 1024, buffer_bytes)
+    for prefix in path_prefixes:
+        prefix_names, prefix_sources = load_document_sources(prefix)
+        first_document = 0
+        for tokens, token_starts, sequence_lengths, document_indices in iter_document_chunks(
+            prefix, chunk_bytes
+        ):
+            num_documents = len(token_starts) - 1
+            targets = rng.integers(num_buckets, size=num_documents)
+            for i, bucket in enumerate(targets.tolist()):
+                bucket_builders[bucket].add_document(
+                    tokens[token_starts[i] : token_starts[i + 1]],
+                    sequence_lengths[document_indices[i] : document_indices[i + 1]].tolist(),
+                )
+                bucket_counts[bucket] += 1
+            chunk_sources = (
+                prefix_sources[first_document : first_document + num_documents].astype(np.uint32)
+                + len(names)
+            )
+            order = np.argsort(targets, kind="stable")
+            bounds = np.searchsorted(targets[order], np.arange(num_buckets + 1))
+            for bucket in np.flatnonzero(np.diff(bounds)).tolist():
+                bucket_source_files[bucket].write(
+                    chunk_sources[order[bounds[bucket] : bounds[bucket + 1]]].tobytes()
+                )
+            first_document += num_documents
+        names.extend(prefix_names)
+    for prefix, builder, source_file in zip(bucket_prefixes, bucket_builders, bucket_source_files):
+        builder.finalize(get_idx_path(prefix))
+        source_file.close()
+    del bucket_builders
+
+    ids_path, names_path = get_source_paths(args.output_prefix)
+    shuffled_sources = np.lib.format.open_memmap(
+        ids_path, mode="w+", dtype=get_source_dtype(len(names)), shape=(sum(bucket_counts),)
+    )
+    first_document = 0
+    builder = IndexedDatasetBuilder(get_bin_path(args.output_prefix), dtype=dtype)
+    for prefix, count in zip(bucket_prefixes, bucket_counts):
+        if count:
+            bucket_sources = np.fromfile(prefix + "_sources.u32", dtype=np.uint32)
+            # a whole bucket is a single chunk
+            for tokens, token_starts, sequence_lengths, document_indices in iter_document_chunks(
+                prefix, float("inf")
+            ):
+                permutation = rng.permutation(len(token_starts) - 1)
+                shuffled_sources[first_document : first_document + count] = bucket_sources[permutation]
+                first_document += count
+                for i in permutation.tolist():
+                    builder.add_document(
+                        tokens[token_starts[i] : token_starts[i + 1]],
+                        sequence_lengths[document_indices[i] : document_indices[i + 1]].tolist(),
+                    )
+        os.remove(get_bin_path(prefix))
+        os.remove(get_idx_path(prefix))
+        os.remove(prefix + "_sources.u32")
+    builder.finalize(get_idx_path(args.output_prefix))
+    shutil.rmtree(bucket_dir)
+    shuffled_sources.flush()
+    del shuffled_sources
+    with open(names_path, "w") as f:
+        json.dump(names, f)
+
+
+def get_packed_index_paths(path_prefix, seq_length):
+    """Paths of the sample offsets and segments arrays of a packed sample index."""
+    stem = "{}_packed_{}sl".format(path_prefix, seq_length)
+    return stem + "_sample_offsets.npy", stem + "_segments.npy"
+
+
+def pack_documents(document_lengths, capacity):
+    """
+    Pack documents into samples of `capacity` tokens with best-fit decreasing.
+
+    Documents longer than `capacity` are cut into full samples first; only
+    their remainders take part in the packing.
+
+    Args:
+        document_lengths: Number of tokens of every document
+        capacity: Number of tokens per sample
+
+    Returns:
+        Tuple of (sample_offsets, segments). Sample i is made of the rows
+        segments[sample_offsets[i]:sample_offsets[i + 1]], each row being
+        (document id, token offset within the document, number of tokens).
+    """
+    document_lengths = np.asarray(document_lengths, dtype=np.int64)
+
+    # Full samples cut from long documents
+    full_counts = document_lengths // capacity
+    full_docs = np.repeat(np.arange(len(document_lengths), dtype=np.int64), full_counts)
+    first_full = np.repeat(np.cumsum(full_counts) - full_counts, full_counts)
+    full_offsets = (np.arange(len(full_docs), dtype=np.int64) - first_full) * capacity
+
+    # Best fit decreasing over the remainders
+    remainders = document_lengths % capacity
+    order = np.argsort(-remainders, kind="stable")
+    order = order[remainders[order] > 0]
+    spaces = []  # sorted distinct free space of the open samples
+    samples_with_space = {}
+    item_samples = []
+    num_packed = 0
+    for length in remainders[order].tolist():
+        i = bisect.bisect_left(spaces, length)
+        if i == len(spaces):
+            sample = num_packed
+            num_packed += 1
+            space = capacity
+        else:
+            space = spaces[i]
+            open_samples = samples_with_space[space]
+            sample = open_samples.pop()
+            if not open_samples:
+                del samples_with_space[space]
+                spaces.pop(i)
+        item_samples.append(sample)
+        space -= length
+        if space > 0:
+            if space not in samples_with_space:
+                bisect.insort(spaces, space)
+                samples_with_space[space] = []
+            samples_with_space[space].append(sample)
+
+    item_samples = np.asarray(item_samples, dtype=np.int64)
+    by_sample = np.argsort(item_samples, kind="stable")
+    packed_docs = order[by_sample]
+    packed_segments = np.stack(
+        [
+            packed_docs,
+            full_counts[packed_docs] * capacity,
+            remainders[packed_docs],
+        ],
+        axis=1,
+    )
+    full_segments = np.stack(
+        [full_docs, full_offsets, np.full(len(full_docs), capacity, dtype=np.int64)],
+        axis=1,
+    )
+    segments = np.concatenate([full_segments, packed_segments])
+
+    packed_sizes = np.bincount(item_samples, minlength=num_packed)
+    sample_sizes = np.concatenate([np.ones(len(full_docs), dtype=np.int64), packed_sizes])
+    sample_offsets = np.zeros(len(sample_sizes) + 1, dtype=np.int64)
+    np.cumsum(sample_sizes, out=sample_offsets[1:])
+    return sample_offsets, segments
+
+
+def build_packed_sample_index(path_prefix, seq_length):
+    """
+    Write a packed sample index for the document-level dataset at `path_prefix`.
+
+    Samples hold seq_length + 1 tokens (inputs plus the shifted label) and are
+    ordered by decreasing remainder length; `PackedDataset` reads them in a
+    seeded random order.
+    """
+    from megatron.core.datasets.indexed_dataset import IndexedDataset
+
+    dataset = IndexedDataset(path_prefix)
+    document_indices = np.asarray(dataset.index.document_indices)
+    # empty documents have no sequence at all, others exactly one
+    assert np.all(np.diff(document_indices) <= 1), "packing requires a document-level dataset"
+    capacity = seq_length + 1
+    sequence_ends = np.concatenate(
+        [[0], np.cumsum(dataset.index.sequence_lengths, dtype=np.int64)]
+    )
+    document_lengths = np.diff(sequence_ends[document_indices])
+    sample_offsets, segments = pack_documents(document_lengths, capacity)
+    del dataset
+
+    sample_offsets_path, segments_path = get_packed_index_paths(path_prefix, seq_length)
+    np.save(sample_offsets_path, sample_offsets)
+    np.save(segments_path, segments)
+
+    num_samples = len(sample_offsets) - 1
+    total_tokens = int(document_lengths.sum())
+    padding = num_samples * capacity - total_tokens
+    logging.info(
+        f"Packed {len(document_lengths)} documents into {num_samples} samples of "
+        f"{capacity} tokens ({padding / max(num_samples * capacity, 1):.2%} padding)"
+    )
+
+
+def get_packed_sample(dataset, sample_offsets, segments, idx, seq_length, pad_id):
+    """Return packed sample `idx` of `dataset`, right-padded with `pad_id`."""
+    sample = np.full(seq_length + 1, pad_id, dtype=dataset.index.dtype)
+    position = 0
+    for doc, offset, length in segments[sample_offsets[idx] : sample_offsets[idx + 1]]:
+        # the single sequence of the document, empty documents are never packed
+        sequence = int(dataset.index.document_indices[doc])
+        sample[position : position + length] = dataset.get(sequence, int(offset), int(length))
+        position += length
+    return sample
+
+
+class PackedDataset(object):
+    """
+    Map-style dataset (usable as a torch Dataset) over a packed sample index.
+
+    Megatron's GPTDataset does not read packed indices, so training needs this
+    adapter or its own equivalent. The index stores samples in packing order,
+    by decreasing remainder length, so they are returned in a permutation
+    fixed by `seed`; pass `seed=None` only if the sampler shuffles instead.
+
+    Every item is a dict with the `seq_length + 1` "tokens" and their
+    "segment_ids": 1, 2, ... for the documents in the sample and 0 for
+    padding, for document-level attention masks, position ids and loss masks.
+    """
+
+    def __init__(self, path_prefix, seq_length, pad_id, seed=1234):
+        from megatron.core.datasets.indexed_dataset import IndexedDataset
+
+        self.dataset = IndexedDataset(path_prefix)
+        sample_offsets_path, segments_path = get_packed_index_paths(path_prefix, seq_length)
+        self.sample_offsets = np.load(sample_offsets_path, mmap_mode="r")
+        self.segments = np.load(segments_path, mmap_mode="r")
+        self.seq_length = seq_length
+        self.pad_id = pad_id
+        self.order = None
+        if seed is not None:
+            self.order = np.random.default_rng(seed).permutation(len(self))
+
+    def __len__(self):
+        return len(self.sample_offsets) - 1
+
+    def __getitem__(self, idx):
+        if self.order is not None:
+            idx = self.order[idx]
+        tokens = get_packed_sample(
+            self.dataset, self.sample_offsets, self.segments, idx, self.seq_length, self.pad_id
+        )
+        lengths = self.segments[self.sample_offsets[idx] : self.sample_offsets[idx + 1], 2]
+        segment_ids = np.zeros(self.seq_length + 1, dtype=np.int32)
+        segment_ids[: lengths.sum()] = np.repeat(np.arange(1, len(lengths) + 1), lengths)
+        return {"tokens": tokens, "segment_ids": segment_ids}
+
+
+def is_arrow_ipc_file(path):
+    """Whether `path` is in the Arrow IPC file format rather than the stream format."""
+    with open(path, "rb") as f:
+        return f.read(6) == b"ARROW1"
+
+
+def convert_to_jsonl(input_file, temp_dir, json_keys, input_format="json", row_filter=None):
+    """
+    Write the `json_keys` of the rows of `input_file` accepted by `row_filter` as jsonl.
+
+    Parquet and Arrow files are read with `pyarrow.dataset`, which only reads
+    the needed columns and evaluates the filter while scanning; for Parquet
+    it also skips row groups whose statistics rule out any match, so rejected
+    rows are never decoded.
+    Arrow files may be in the IPC file or the IPC stream format.
+    """
+    # the full name keeps x.parquet and x.arrow of one directory apart
+    output_file = os.path.join(temp_dir, f"{os.path.basename(input_file)}.jsonl")
+    if input_format == "json":
+        with open(input_file, "r") as f:
+            data = json.load(f)
+            with open(output_file, "w") as out:
+                for line in data:
+                    if row_filter is not None and not row_filter(line):
+                        continue
+                    json.dump({k: line[k] for k in json_keys}, out)
+                    out.write("\n")
+    elif input_format in ("parquet", "arrow"):
+        import pyarrow.dataset as ds
+
+        expression = row_filter.arrow_expression() if row_filter is not None else None
+        if input_format == "arrow" and not is_arrow_ipc_file(input_file):
+            # Hugging Face `datasets` writes the Arrow IPC stream format
+            import pyarrow as pa
+
+            scanner = ds.Scanner.from_batches(
+                pa.ipc.open_stream(pa.memory_map(input_file)), columns=json_keys, filter=expression
+            )
+        else:
+            scanner = ds.dataset(input_file, format=input_format).scanner(
+                columns=json_keys, filter=expression
+            )
+        with open(output_file, "w", encoding="utf-8") as out:
+            for batch in scanner.to_batches():
+                for row in batch.to_pylist():
+                    out.write(json.dumps(row, ensure_ascii=False) + "\n")
+    else:
+        raise ValueError(f"Unsupported input format: {input_format}")
+    return output_file
+
+
+def stage_file(path, staging_dir, stale_seconds=60):
+    """
+    Copy `path` into the node-local `staging_dir` with large sequential reads.
+
+    Concurrent callers on the same node wait for the first copy instead of
+    starting their own; if that copy stalls, the shared path is returned.
+
+    Returns:
+        Path of the staged copy, or `path` if staging was given up
+    """
+    os.makedirs(staging_dir, exist_ok=True)
+    staged = os.path.join(staging_dir, os.path.basename(path))
+    partial = staged + ".partial"
+    while not os.path.exists(staged):
+        try:
+            fd = os.open(partial, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(partial) > stale_seconds:
+                    return path
+            except FileNotFoundError:
+                pass
+            time.sleep(1)
+            continue
+        try:
+            with os.fdopen(fd, "wb") as fout, open(path, "rb") as fin:
+                shutil.copyfileobj(fin, fout, 64 * 1024 * 1024)
+            # keep the mtime, so the sidecar of the original (see `get_line_index_path`)
+            # stays valid for the copy when it is looked up in the original's directory
+            shutil.copystat(path, partial)
+            os.replace(partial, staged)
+        except BaseException:
+            os.remove(partial)
+            raise
+    return staged
+
+
+def preprocess_data_task(preprocess_data_args, dedup_shards=None, prefetch_input=None):
+    """
+    Dedup and tokenize one input file; run as a Ray task by `run`.
+
+    With --scratch-dir the input is staged to node-local scratch first, and
+    `prefetch_input` (path, staging directory) of a file expected to run next
+    is copied there in the background while this one is encoded.
+
+    Raises ValueError if more than --max-error-rate of the lines are
+    malformed. On any failure the partial outputs are removed, so the task
+    can be retried or its input quarantined.
+    """
+    sampler = MemorySampler()
+    try:
+        result = tokenize_input(preprocess_data_args, dedup_shards, prefetch_input)
+    finally:
+        peak_memory = get_peak_memory(sampler, preprocess_data_args.workers)
+    return dict(result, peak_memory=peak_memory)
+
+
+def tokenize_input(preprocess_data_args, dedup_shards, prefetch_input):
+    """Body of `preprocess_data_task`, whose memory is sampled while this runs."""
+    import ray
+
+    original_input = preprocess_data_args.input
+    staging_dir = preprocess_data_args.staging_dir
+    prefetch = None
+    if staging_dir:
+        if prefetch_input is not None:
+            prefetch = threading.Thread(target=stage_file, args=prefetch_input, daemon=True)
+            prefetch.start()
+        input_path = preprocess_data_args.input
+        staged_input = stage_file(input_path, os.path.join(staging_dir, "inputs"))
+        # the staged copy has the name and mtime of the original, so it shares its sidecar
+        preprocess_data_args = argparse.Namespace(
+            **dict(
+                vars(preprocess_data_args),
+                input=staged_input,
+                line_index_dir=preprocess_data_args.line_index_dir or os.path.dirname(input_path),
+            )
+        )
+
+    # Parquet/Arrow inputs are filtered while converting, so later steps see jsonl
+    converted_input = None
+    input_format = INPUT_FORMATS[os.path.splitext(preprocess_data_args.input)[1]]
+    if input_format != "jsonl":
+        converted_dir = os.path.join(
+            staging_dir or os.path.dirname(preprocess_data_args.output_prefix), "converted"
+        )
+        os.makedirs(converted_dir, exist_ok=True)
+        converted_input = convert_to_jsonl(
+            preprocess_data_args.input,
+            converted_dir,
+            preprocess_data_args.json_keys,
+            input_format,
+            RowFilter(preprocess_data_args),
+        )
+        preprocess_data_args = argparse.Namespace(
+            **dict(
+                vars(preprocess_data_args),
+                input=converted_input,
+                line_index_dir=None,
+                filter=[],
+                min_chars=None,
+                max_chars=None,
+            )
+        )
+
+    # partial outputs of a failed attempt must not be merged
+    try:
+        keep, stats = None, None
+        if dedup_shards:
+            keep, stats = find_duplicates(
+                preprocess_data_args, dedup_shards, owner=get_dedup_owner(original_input)
+            )
+        encode_start = time.time()
+        encode_stats = preprocess_data(preprocess_data_args, keep=keep)
+        encode_seconds = time.time() - encode_start
+        if encode_stats["errors"] > preprocess_data_args.max_error_rate * encode_stats["lines"]:
+            raise ValueError(
+                f"{encode_stats['errors']} of {encode_stats['lines']} lines of "
+                f"{original_input} are malformed"
+            )
+        documents = count_lines(preprocess_data_args.input, preprocess_data_args.line_index_dir)
+    except BaseException:
+        remove_file_outputs(preprocess_data_args.output_prefix)
+        raise
+    finally:
+        if converted_input is not None:
+            os.remove(converted_input)
+            if os.path.exists(get_line_index_path(converted_input)):
+                os.remove(get_line_index_path(converted_input))
+        if staging_dir:
+            if staged_input != input_path:
+                os.remove(staged_input)
+            if prefetch is not None:
+                prefetch.join()
+    return {
+        "dedup_stats": stats,
+        "encode_stats": encode_stats,
+        "node_id": ray.get_runtime_context().get_node_id(),
+        "documents": documents,
+        "input_bytes": os.path.getsize(original_input),
+        "encode_seconds": encode_seconds,
+    }
+
+
+def remove_file_outputs(output_prefix):
+    """Remove the outputs of one input file for every tokenizer, key and partition."""
+    pattern = os.path.join(
+        glob.escape(os.path.dirname(output_prefix)),
+        "**",
+        glob.escape(os.path.basename(output_prefix)) + "_*",
+    )
+    for path in glob.glob(pattern, recursive=True):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def read_proc_file(path):
+    """Contents of a /proc file, or None once the process is gone."""
+    # plain os reads take no Python-level locks a forked encoder could inherit
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        chunks = []
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                return b"".join(chunks)
+            chunks.append(chunk)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+
+def get_process_memory(pid):
+    """PSS of one process in bytes (RSS on kernels without smaps_rollup), or 0 once it is gone."""
+    rollup = read_proc_file(f"/proc/{pid}/smaps_rollup")
+    if rollup:
+        match = re.search(rb"^Pss:\s+(\d+) kB", rollup, re.MULTILINE)
+        if match:
+            return int(match.group(1)) * 1024
+    statm = read_proc_file(f"/proc/{pid}/statm")
+    if not statm:
+        return 0
+    return int(statm.split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def get_process_tree_memory(pid):
+    """Memory of `pid` and all its descendants in bytes, from /proc."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        stat = read_proc_file(f"/proc/{entry}/stat")
+        if not stat:
+            continue
+        # the command name may contain spaces and parentheses; ppid follows state
+        ppid = int(stat[stat.rindex(b")") + 2 :].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+    total, pending = 0, [pid]
+    while pending:
+        pid = pending.pop()
+        total += get_process_memory(pid)
+        pending.extend(children.get(pid, ()))
+    return total
 
-    in_ss_out_names = []
-    if args.partitions == 1:
-        file_name, extension = os.path.splitext(args.input)
-        sentence_split_file = file_name + "_ss" + extension
-        file_names = {
-            "partition": args.input,
-            "sentence_split": sentence_split_file,
-            "output_prefix": args.output_prefix,
-        }
-        in_ss_out_names.append(file_names)
-    else:
-        in_file_names = glob.glob(args.input)
-
-        # Count total number of lines across .jsonl files
-        if args.keep_sequential_samples:
-            total_sample_count = 0
-            for filename in in_file_names:
-                with open(filename, "r") as fin:
-                    for fc, _ in enumerate(fin):
-                        pass
-                total_sample_count += fc + 1
-            partition_size = math.ceil(total_sample_count / args.partitions)
-
-        # create .jsonl parition files
-        for idx in range(args.partitions):
-            in_ss_out_name = get_file_name(args, idx)
-            in_ss_out_names.append(in_ss_out_name)
-
-        # check to see if paritions were already created
-        partitions_present = check_files_exist(
-            in_ss_out_names, "partition", args.partitions
-        )
 
-        # check to see if paritions with split sentences already created
-        split_sentences_present = check_files_exist(
-            in_ss_out_names, "sentence_split", args.partitions
-        )
+class MemorySampler(object):
+    """
+    Samples the memory of this process and its descendants on a background thread.
 
-        if not partitions_present and not split_sentences_present:
-            # populate .jsonl partition files from parent files
-            partitioned_input_files = []
-            for idx in range(args.partitions):
-                partitioned_input_file = open(in_ss_out_names[idx]["partition"], "w")
-                partitioned_input_files.append(partitioned_input_file)
+    Ray reuses worker processes and tasks run largest first, so the kernel's
+    lifetime maximum (ru_maxrss) would report the biggest earlier task. PSS
+    counts the pages the forked encoders share with their parent once.
+    """
 
-            index = 0
-            if args.keep_sequential_samples:
-                line_count = 0
-            for in_file_name in in_file_names:
-                # support for gzip files
-                if in_file_name.endswith(".gz"):
-                    fin = gzip.open(in_file_name, "rt")
-                else:
-                    fin = open(in_file_name, "r", encoding="utf-8")
-
-                for line in fin:
-                    partitioned_input_files[index].write(line)
-                    if args.keep_sequential_samples:
-                        line_count += 1
-                        if line_count % partition_size == 0:
-                            index += 1
-                    else:
-                        index = (index + 1) % args.partitions
+    def __init__(self, interval=1.0):
+        self.peak = 0
+        self.available = os.path.exists(f"/proc/{os.getpid()}/statm")
+        self.stopped = threading.Event()
+        self.thread = None
+        if self.available:
+            self.thread = threading.Thread(target=self._run, args=(interval,), daemon=True)
+            self.thread.start()
 
-                fin.close()
+    def _run(self, interval):
+        while True:
+            self.peak = max(self.peak, get_process_tree_memory(os.getpid()))
+            if self.stopped.wait(interval):
+                return
 
-            for idx in range(args.partitions):
-                partitioned_input_files[idx].close()
+    def stop(self):
+        """Stop sampling and return the peak in bytes."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        return self.peak
 
-    assert args.workers % args.partitions == 0
-    partition = Partition(args, args.workers // args.partitions)
 
-    # check to see if paritions with split sentences already created
-    split_sentences_present = check_files_exist(
-        in_ss_out_names, "sentence_split", args.partitions
-    )
+def get_peak_memory(sampler, workers):
+    """
+    Peak memory of this task in bytes, as measured by `sampler`.
 
-    # split sentences in partition files
-    if args.split_sentences and not split_sentences_present:
-        processes = []
-        for name in in_ss_out_names:
-            p = multiprocessing.Process(
-                target=partition.split_sentences,
-                args=((name["partition"], name["sentence_split"]),),
-            )
-            p.start()
-            processes.append(p)
+    Without /proc this falls back to an upper bound from ru_maxrss, a lifetime
+    maximum that overestimates on reused Ray workers but errs on the safe side
+    for admission control.
+    """
+    if sampler.available:
+        return sampler.stop()
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return (self_rss + workers * child_rss) * 1024
 
-        for p in processes:
-            p.join()
 
-        if args.partitions == 1:
-            return
-
-    # encode partition files in parallel
-    processes = []
-    input_key = "sentence_split" if args.split_sentences else "partition"
-    for name in in_ss_out_names:
-        p = multiprocessing.Process(
-            target=partition.process_json_file,
-            args=((name[input_key], name["output_prefix"]),),
-        )
-        p.start()
-        processes.append(p)
+class TaskMemoryEstimator(object):
+    """
+    Predicts the peak memory of a tokenization task as base + per_doc * documents.
 
-    for p in processes:
-        p.join()
+    Starts from the configured priors and refits both terms on the measured
+    (documents, peak memory) of every finished task, using the upper envelope
+    of the fit so no measured task would have been underestimated. Documents
+    are counted from an existing line index sidecar, or estimated from the
+    input size and the measured average document size.
+    """
 
-    if args.partitions == 1:
-        return
+    def __init__(self, base_bytes, bytes_per_doc, line_index_dir=None, safety_factor=1.2):
+        self.base_bytes = base_bytes
+        self.bytes_per_doc = bytes_per_doc
+        self.line_index_dir = line_index_dir
+        self.safety_factor = safety_factor
+        self.input_bytes_per_doc = 4096.0
+        self.measurements = []
 
-    # merge bin/idx partitions
-    level = "document"
-    if args.split_sentences:
-        level = "sentence"
+    def documents(self, input_path):
+        index_path = get_line_index_path(input_path, self.line_index_dir)
+        if os.path.isfile(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(input_path):
+            return len(np.load(index_path, mmap_mode="r")) - 1
+        return os.path.getsize(input_path) / self.input_bytes_per_doc
 
-    output_bin_files = {}
-    output_idx_files = {}
-    builders = {}
-    tokenizer = build_tokenizer(args)
-
-    for key in args.json_keys:
-        output_bin_files[key] = "{}_{}_{}.bin".format(args.output_prefix, key, level)
-        output_idx_files[key] = "{}_{}_{}.idx".format(args.output_prefix, key, level)
-        builders[key] = indexed_dataset.IndexedDatasetBuilder(
-            output_bin_files[key],
-            dtype=indexed_dataset.DType.optimal_dtype(tokenizer.vocab_size),
-        )
+    def estimate(self, input_path):
+        return int(self.safety_factor * (self.base_bytes + self.bytes_per_doc * self.documents(input_path)))
 
-        for name in in_ss_out_names:
-            parition_output_prefix = name["output_prefix"]
-            full_partition_output_prefix = "{}_{}_{}".format(
-                parition_output_prefix, key, level
-            )
-            builders[key].add_index(full_partition_output_prefix)
-        builders[key].finalize(output_idx_files[key])
+    def update(self, documents, input_bytes, peak_memory):
+        self.measurements.append((documents, input_bytes, peak_memory))
+        docs, sizes, peaks = (np.array(column, dtype=np.float64) for column in zip(*self.measurements))
+        if docs.sum() > 0:
+            self.input_bytes_per_doc = sizes.sum() / docs.sum()
+        if len(np.unique(docs)) > 1:
+            bytes_per_doc, base_bytes = np.polyfit(docs, peaks, 1)
+            bytes_per_doc = max(bytes_per_doc, 0.0)
+        else:
+            bytes_per_doc, base_bytes = self.bytes_per_doc, 0.0
+        # lift the fit until it covers every measurement
+        self.base_bytes = max(base_bytes + (peaks - base_bytes - bytes_per_doc * docs).max(), 0.0)
+        self.bytes_per_doc = bytes_per_doc
 
 
-def merge_datasets(args):
-    prefixes = set()
-    for basename in os.listdir(args.input):
-        prefix, ext = os.path.splitext(basename)
+def merge_staged_outputs(merge_datasets_args_list, staging_dir):
+    """Merge the per-file outputs staged on this node, then free its scratch space. Runs pinned to the node."""
+    for merge_datasets_args in merge_datasets_args_list:
+        os.makedirs(os.path.dirname(merge_datasets_args.output_prefix), exist_ok=True)
+        merge_datasets(merge_datasets_args)
+    shutil.rmtree(staging_dir)
 
-        if prefix in prefixes:
-            continue
 
-        if not os.path.isfile(os.path.join(args.input, basename)):
-            continue
+def is_file_tokenized(output_prefix, json_keys, tokenizer_names=(None,)):
+    """Check if a file has already been tokenized by looking for .bin and .idx files of every tokenizer."""
+    level = "document"  # Assuming default is document level
+    for tokenizer_name in tokenizer_names:
+        tokenizer_prefix = get_tokenizer_output_prefix(output_prefix, tokenizer_name)
+        for key in json_keys:
+            # File format: output_prefix_key_level.bin
+            # Example: /path/001_00005.jsonl_text_document.bin
+            bin_file = "{}_{}{}{}.bin".format(tokenizer_prefix, key, "_" if key else "", level)
+            idx_file = "{}_{}{}{}.idx".format(tokenizer_prefix, key, "_" if key else "", level)
+            bin_exists = os.path.isfile(bin_file)
+            idx_exists = os.path.isfile(idx_file)
+            if not (bin_exists and idx_exists):
+                return False
+    return True
 
-        ext_pair = ".bin" if ext == ".idx" else ".idx"
-        assert os.path.isfile(
-            os.path.join(args.input, prefix) + ext_pair
-        ), f"ERROR: {ext_pair} file not provided for {os.path.join(args.input, prefix)}"
 
-        prefixes.add(prefix)
+def get_manifest_path(output_dir):
+    return os.path.join(output_dir, "manifest.json")
 
-    builder = None
-    for prefix in sorted(prefixes):
-        if builder is None:
-            dataset = IndexedDataset(
-                os.path.join(args.input, prefix), multimodal=args.multimodal
-            )
-            builder = IndexedDatasetBuilder(
-                get_bin_path(args.output_prefix),
-                dtype=dataset.index.dtype,
-                multimodal=args.multimodal,
-            )
-            del dataset
 
-        builder.add_index(os.path.join(args.input, prefix))
+def load_manifest(output_dir):
+    """
+    Load the manifest of an output directory, empty if there is none.
 
-    builder.finalize(get_idx_path(args.output_prefix))
+    It maps every input file name to the size and mtime the file had when it
+    was processed, its status ("tokenized", "merged" or "quarantined"), and
+    its line counts or the error that quarantined it.
+    """
+    manifest_path = get_manifest_path(output_dir)
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path, "r") as f:
+        return json.load(f)
 
 
-def convert_to_jsonl(input_file, temp_dir, json_keys, input_format="json"):
-    # TODO: Add support for other formats
-    base_name = os.path.basename(input_file).split(".")[0]
-    output_file = os.path.join(temp_dir, f"{base_name}.jsonl")
-    if input_format == "json":
-        with open(input_file, "r") as f:
-            data = json.load(f)
-            with open(output_file, "w") as out:
-                for line in data:
-                    json.dump({k: line[k] for k in json_keys}, out)
-                    out.write("\n")
-    return output_file
+def write_manifest(output_dir, manifest):
+    manifest_path = get_manifest_path(output_dir)
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_path + ".tmp", manifest_path)
 
 
-@ray.remote(num_cpus=args.cpus_per_ray_worker)
-def preprocess_data_ray(preprocess_data_args):
-    # TODO: Convert to jsonl
-    preprocess_data(preprocess_data_args)
+def get_input_signature(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
 
 
-def is_file_tokenized(output_prefix, json_keys):
-    """Check if a file has already been tokenized by looking for .bin and .idx files."""
-    level = "document"  # Assuming default is document level
-    for key in json_keys:
-        # File format: output_prefix_key_level.bin
-        # Example: /path/001_00005.jsonl_text_document.bin
-        bin_file = "{}_{}{}{}.bin".format(output_prefix, key, "_" if key else "", level)
-        idx_file = "{}_{}{}{}.idx".format(output_prefix, key, "_" if key else "", level)
-        bin_exists = os.path.isfile(bin_file)
-        idx_exists = os.path.isfile(idx_file)
-        if not (bin_exists and idx_exists):
-            return False
-    return True
+def matches_input(entry, path):
+    """Whether a manifest entry was recorded for the current contents of `path`."""
+    signature = get_input_signature(path)
+    return entry.get("size") == signature["size"] and entry.get("mtime") == signature["mtime"]
 
 
-def filter_files_to_process(all_files, output_dir, json_keys, keep_last_n=10):
+def filter_files_to_process(
+    all_files,
+    output_dir,
+    json_keys,
+    keep_last_n=10,
+    tokenizer_names=(None,),
+    manifest=None,
+    retry_quarantined=False,
+):
     """
     Filter files to process, skipping already tokenized ones except the last N files by modification date.
+
+    Files with a `manifest` entry for their current size and mtime skip that
+    heuristic: merged and quarantined files are skipped, tokenized files if
+    their outputs are still there.
     
     Args:
         all_files: List of input files to process
         output_dir: Directory containing tokenized output
         json_keys: JSON keys used for tokenization (for checking output files)
         keep_last_n: Number of last files (by modification date) to always process (default: 10)
+        tokenizer_names: Names of the tokenizers whose outputs must all exist (None for a single tokenizer)
+        manifest: Manifest of the job's output directory, see `load_manifest`
+        retry_quarantined: Process quarantined files again
     
     Returns:
         List of files that need to be processed
@@ -342,6 +2485,17 @@ def filter_files_to_process(all_files, output_dir, json_keys, keep_last_n=10):
         basename_with_ext = os.path.basename(file)  # e.g., "001_00005.jsonl"
         output_prefix = os.path.join(output_dir, basename_with_ext)  # Keep the .jsonl extension
         
+        entry = (manifest or {}).get(basename_with_ext)
+        if entry is not None and matches_input(entry, file):
+            status = entry["status"]
+            if status == "merged" or (status == "quarantined" and not retry_quarantined):
+                logging.info(f"Skipping {status} file: {basename_with_ext}")
+            elif status == "tokenized" and is_file_tokenized(output_prefix, json_keys, tokenizer_names):
+                logging.info(f"Skipping already tokenized file: {basename_with_ext}")
+            else:
+                files_to_process.append(file)
+            continue
+
         # Always process recently modified files
         if file in recent_files_set:
             files_to_process.append(file)
@@ -350,7 +2504,7 @@ def filter_files_to_process(all_files, output_dir, json_keys, keep_last_n=10):
             continue
         
         # For other files, check if they've been tokenized
-        if not is_file_tokenized(output_prefix, json_keys):
+        if not is_file_tokenized(output_prefix, json_keys, tokenizer_names):
             files_to_process.append(file)
             base_name = os.path.splitext(basename_with_ext)[0]
             logging.info(f"File {base_name} needs tokenization")
@@ -367,76 +2521,875 @@ def filter_files_to_process(all_files, output_dir, json_keys, keep_last_n=10):
     return files_to_process
 
 
-if __name__ == "__main__":
+def make_preprocess_data_args(args, input_path, output_prefix, staging_dir=None):
+    """Build the per-file arguments of `preprocess_data` from the driver arguments."""
+    preprocess_data_args = argparse.Namespace(
+        input=input_path,
+        json_keys=args.json_keys,
+        split_sentences=args.split_sentences,
+        keep_newlines=args.keep_newlines,
+        append_eod=args.append_eod,
+        lang=args.lang,
+        output_prefix=output_prefix,
+        workers=args.workers,
+        partitions=args.partitions,
+        log_interval=args.log_interval,
+        keep_sequential_samples=args.keep_sequential_samples,
+        tokenizer_type=args.tokenizer_type,
+        vocab_size=args.vocab_size,
+        vocab_file=args.vocab_file,
+        merge_file=args.merge_file,
+        tokenizer_model=args.tokenizer_model,
+        tiktoken_pattern=args.tiktoken_pattern,
+        tiktoken_num_special_tokens=args.tiktoken_num_special_tokens,
+        tiktoken_special_tokens=args.tiktoken_special_tokens,
+        tokenizers=args.tokenizers,
+        dedup=args.dedup,
+        minhash_num_perm=args.minhash_num_perm,
+        minhash_bands=args.minhash_bands,
+        minhash_ngram=args.minhash_ngram,
+        staging_dir=staging_dir,
+        line_index_dir=args.line_index_dir,
+        max_error_rate=args.max_error_rate,
+        filter=args.filter,
+        min_chars=args.min_chars,
+        max_chars=args.max_chars,
+        read_queue_depth=args.read_queue_depth,
+        write_queue_depth=args.write_queue_depth,
+        encode_batch_size=args.encode_batch_size,
+        long_doc_chars=0 if args.split_sentences else args.long_doc_chars,
+        long_doc_segment_chars=args.long_doc_segment_chars,
+    )
+    return add_tokenizer_defaults(preprocess_data_args)
+
+
+def add_tokenizer_defaults(args):
+    """Set the Megatron training arguments that `build_tokenizer` reads, and return `args`."""
+    args.rank = 1
+    args.make_vocab_size_divisible_by = 128
+    args.tensor_model_parallel_size = 1
+    args.vocab_extra_ids = 0
+    return args
+
+
+def merge_node_outputs(job, tokenizer_names, all_merge_datasets_args):
+    """
+    Merge the outputs a job staged on node-local scratch, on their nodes.
+
+    If all of them are on a single node and nothing was written to the shared
+    temp directory before, they are merged straight into the final output.
+    Otherwise every node writes one merged file per tokenizer into the shared
+    temp directory, which the regular merge then picks up. If any node fails,
+    the node files are removed again, so the next run tokenizes the staged
+    inputs anew instead of merging them twice.
+
+    Returns:
+        True if the final outputs were already written
+    """
+    import ray
+    from ray.util.scheduling_strategies import NodeAffinitySchedulingStrategy
+
+    staged_temp_dir = os.path.join(job["staging_dir"], "temp")
+    direct = len(job["staged_nodes"]) == 1 and not any(
+        name.endswith(".idx")
+        for _, _, names in os.walk(job["temp_output_dir"])
+        for name in names
+    )
+    merge_staged = ray.remote(num_cpus=1)(merge_staged_outputs)
+
+    refs = []
+    for node_id in sorted(job["staged_nodes"]):
+        node_merge_args = []
+        for tokenizer_name, merge_datasets_args in zip(tokenizer_names, all_merge_datasets_args):
+            staged_input = get_tokenizer_output_dir(staged_temp_dir, tokenizer_name)
+            if direct:
+                node_merge_args.append(
+                    argparse.Namespace(**dict(vars(merge_datasets_args), input=staged_input))
+                )
+            else:
+                node_merge_args.append(
+                    argparse.Namespace(
+                        input=staged_input,
+                        output_prefix=os.path.join(merge_datasets_args.input, f"node-{node_id}"),
+                        multimodal=False,
+                    )
+                )
+        strategy = NodeAffinitySchedulingStrategy(node_id=node_id, soft=False)
+        refs.append(
+            merge_staged.options(scheduling_strategy=strategy).remote(
+                node_merge_args, job["staging_dir"]
+            )
+        )
+    # the staged per-file outputs of a node are gone once it merged them, so
+    # after a failure its node-<id> files would duplicate the retokenized inputs
+    ray.wait(refs, num_returns=len(refs))
+    try:
+        ray.get(refs)
+    except BaseException:
+        for merge_datasets_args in all_merge_datasets_args:
+            for path in glob.glob(os.path.join(glob.escape(merge_datasets_args.input), "node-*")):
+                os.remove(path)
+        raise
+    return direct
+
+
+def carry_over_merged(merge_datasets_args, removed_inputs):
+    """
+    Move the merged dataset of an earlier run into the merge input, so the new merge extends it.
+
+    Documents of `removed_inputs` (file names processed again because they
+    changed) are left out by copying the rest with `build_subset`.
+    """
+    from megatron.core.datasets.indexed_dataset import get_bin_path, get_idx_path
+
+    previous = merge_datasets_args.output_prefix
+    if not os.path.isfile(get_idx_path(previous)):
+        return
+    carried = os.path.join(merge_datasets_args.input, "000-previous-merged")
+    os.makedirs(merge_datasets_args.input, exist_ok=True)
+
+    names, sources = load_document_sources(previous)
+    stale = [
+        i for i, name in enumerate(names)
+        if any(name.startswith(f"{removed}_") for removed in removed_inputs)
+    ]
+    if stale:
+        documents = np.flatnonzero(~np.isin(sources, stale))
+        build_subset(previous, carried, documents, copy=True)
+        write_document_sources(carried, names, sources[documents])
+        for path in (get_bin_path(previous), get_idx_path(previous)) + get_source_paths(previous):
+            os.remove(path)
+    else:
+        os.replace(get_bin_path(previous), get_bin_path(carried))
+        os.replace(get_idx_path(previous), get_idx_path(carried))
+        for path, carried_path in zip(get_source_paths(previous), get_source_paths(carried)):
+            if os.path.isfile(path):
+                os.replace(path, carried_path)
+    logging.info(
+        f"Extending {previous} ({len(sources)} documents, {len(stale)} stale sources dropped)"
+    )
+
+
+def finish_job(args, job, tokenizer_names):
+    """
+    Report, merge and clean up one input/output directory pair once all its files are done.
+
+    Quarantined files are left out. The merged dataset of an earlier run is
+    extended rather than rebuilt, and the manifest marks every merged input.
+    """
+    output_dir = job["output_dir"]
+    temp_output_dir = job["temp_output_dir"]
+
+    if args.dedup != "none":
+        report_dedup_stats(job["dedup_stats"], os.path.join(output_dir, "dedup_stats.jsonl"))
+    if job["quarantined"]:
+        logging.warning(
+            f"{len(job['quarantined'])} inputs of {output_dir} were quarantined, "
+            f"see {get_manifest_path(output_dir)}"
+        )
+
+    if job["staged_nodes"] or any(
+        name.endswith(".idx") for _, _, names in os.walk(temp_output_dir) for name in names
+    ):
+        merge_job_outputs(args, job, tokenizer_names)
+    else:
+        logging.info(f"No new outputs for {output_dir}, keeping its merged dataset")
+
+    for file in job["files"]:
+        name = os.path.basename(file)
+        entry = job["manifest"].get(name)
+        if entry is not None and entry["status"] == "quarantined" and matches_input(entry, file):
+            continue
+        job["manifest"][name] = dict(entry or get_input_signature(file), status="merged")
+    write_manifest(output_dir, job["manifest"])
+
+    shutil.rmtree(temp_output_dir)
+
+
+def merge_job_outputs(args, job, tokenizer_names):
+    """Merge the per-file outputs of a job, and any earlier merged dataset, per tokenizer."""
+    output_dir = job["output_dir"]
+    temp_output_dir = job["temp_output_dir"]
+
+    all_merge_datasets_args = []
+    for tokenizer_name in tokenizer_names:
+        tokenizer_output_dir = get_tokenizer_output_dir(output_dir, tokenizer_name)
+        os.makedirs(tokenizer_output_dir, exist_ok=True)
+        all_merge_datasets_args.append(
+            argparse.Namespace(
+                input=get_tokenizer_output_dir(temp_output_dir, tokenizer_name),
+                output_prefix=os.path.join(tokenizer_output_dir, "merged"),
+                multimodal=False,
+                shuffle=args.shuffle_merge,
+                shuffle_seed=args.shuffle_seed,
+                shuffle_buffer_mb=args.shuffle_buffer_mb,
+            )
+        )
+        if job["extend_merged"]:
+            carry_over_merged(all_merge_datasets_args[-1], job["reprocessed_merged"])
+
+    merged = False
+    if job["staged_nodes"]:
+        logging.info(f"=====Merging staged outputs of {output_dir} on their nodes=====\n")
+        merged = merge_node_outputs(job, tokenizer_names, all_merge_datasets_args)
+
+    for tokenizer_name, merge_datasets_args in zip(tokenizer_names, all_merge_datasets_args):
+        if not merged:
+            logging.info(
+                f"=====Merging datasets of {output_dir}"
+                f"{f' ({tokenizer_name})' if tokenizer_name else ''}=====\n"
+            )
+            merge_datasets(merge_datasets_args)
+
+        if args.pack_sequences:
+            logging.info("=====Packing sequences=====\n")
+            build_packed_sample_index(merge_datasets_args.output_prefix, args.seq_length)
+
+
+def get_autotune_path(output_dir):
+    return os.path.join(output_dir, "autotune.json")
+
+
+def get_autotune_key(args, node_cpus):
+    """What a recorded autotune choice depends on: node size, tokenizers and keys."""
+    return {
+        "node_cpus": node_cpus,
+        "tokenizers": [
+            f"{t.tokenizer_type}:{t.tokenizer_model or t.vocab_file}" for t in get_tokenizer_args(args)
+        ],
+        "json_keys": args.json_keys,
+        "split_sentences": args.split_sentences,
+    }
+
+
+def load_autotune(output_dirs, key):
+    """Return the first recorded autotune choice in `output_dirs` made for `key`, or None."""
+    for output_dir in output_dirs:
+        try:
+            with open(get_autotune_path(output_dir)) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if record.get("key") == key:
+            return record
+    return None
+
+
+def get_autotune_candidates(args, node_cpus):
+    """
+    Configurations tried by `autotune`, all with --encode-batch-size.
+
+    Tasks of 1 to `node_cpus` CPUs with one encoder per CPU, in 1 or 2
+    partitions, plus the configuration given on the command line.
+    """
+    candidates = []
+    if args.cpus_per_ray_worker <= node_cpus:
+        candidates.append((args.cpus_per_ray_worker, args.workers, args.partitions))
+    for cpus in sorted({1, 2, 4, 8, 16, 32, 64, args.cpus_per_ray_worker}):
+        if cpus > node_cpus:
+            continue
+        for partitions in (1, 2):
+            if cpus % partitions == 0 and (cpus, cpus, partitions) not in candidates:
+                candidates.append((cpus, cpus, partitions))
+    return [
+        {
+            "cpus_per_ray_worker": cpus,
+            "workers": workers,
+            "partitions": partitions,
+            "encode_batch_size": args.encode_batch_size,
+        }
+        for cpus, workers, partitions in candidates
+    ]
+
+
+def write_calibration_sample(files, path, sample_bytes):
+    """Write the first lines of `files`, about `sample_bytes` in total, to `path`."""
+    with open(path, "wb") as fout:
+        for file in files:
+            with open(file, "rb") as fin:
+                fout.writelines(fin.readlines(max(1, sample_bytes // len(files))))
+
+
+def measure_config(args, config, files, calibration_dir, cluster_cpus, preprocess_data_ray):
+    """
+    Run one calibration pass of `config` with a task on every slot of the cluster.
+
+    Every task encodes --autotune-sample-mb per worker of the first lines of
+    `files`. Its throughput excludes the tokenizer and pool startup, which is
+    paid once per input and negligible for full-size inputs.
+
+    Returns:
+        Input bytes per second of all tasks together, 0 if a task failed
+    """
+    import ray
+
+    config_args = argparse.Namespace(**dict(vars(args), **config))
+    config_dir = os.path.join(calibration_dir, "-".join(str(value) for value in config.values()))
+    os.makedirs(config_dir, exist_ok=True)
+    sample_path = os.path.join(config_dir, "sample.jsonl")
+    write_calibration_sample(
+        files, sample_path, int(args.autotune_sample_mb * 1024**2 * config["workers"])
+    )
+
+    refs = []
+    for slot in range(max(1, int(cluster_cpus // config["cpus_per_ray_worker"]))):
+        # partition files and line index sidecars are written next to the
+        # input, so every slot reads the sample through its own link
+        slot_dir = os.path.join(config_dir, f"slot{slot:04d}")
+        os.makedirs(slot_dir, exist_ok=True)
+        input_path = os.path.join(slot_dir, "sample.jsonl")
+        os.symlink(sample_path, input_path)
+        task_args = make_preprocess_data_args(config_args, input_path, os.path.join(slot_dir, "sample"))
+        task_args.line_index_dir = None
+        task_args.max_error_rate = 1.0
+        refs.append(
+            preprocess_data_ray.options(
+                num_cpus=config["cpus_per_ray_worker"], max_retries=0
+            ).remote(task_args)
+        )
+    try:
+        results = ray.get(refs)
+    except Exception as e:
+        logging.warning(f"Calibration pass {config} failed: {e}")
+        return 0.0
+    finally:
+        shutil.rmtree(config_dir, ignore_errors=True)
+    return sum(
+        result["input_bytes"]
+        / max(result["encode_seconds"] - result["encode_stats"]["startup_seconds"], 1e-3)
+        for result in results
+    )
+
+
+def autotune(args, files, calibration_dir, preprocess_data_ray, node_cpus):
+    """
+    Pick the fastest task configuration for this cluster from calibration passes.
+
+    Every candidate of `get_autotune_candidates` runs once on the first lines
+    of `files` (see `measure_config`), then --encode-batch-size is varied for
+    the fastest one. Dedup, staging and the memory budget are left out of the
+    calibration.
+
+    Args:
+        args: Driver arguments, only read
+        files: Inputs to sample the calibration input from
+        calibration_dir: Shared directory for the calibration inputs and outputs
+        preprocess_data_ray: `preprocess_data_task` as a Ray remote function
+        node_cpus: CPUs of the largest node, the upper bound of a task's CPUs
+
+    Returns:
+        Dictionary with the chosen "config", its "throughput_mb_s" and all
+        "measurements"
+    """
+    import ray
+
+    cluster_cpus = ray.cluster_resources().get("CPU", 1)
+    os.makedirs(calibration_dir, exist_ok=True)
+
+    measurements = []
+
+    def measure(config):
+        throughput = measure_config(
+            args, config, files, calibration_dir, cluster_cpus, preprocess_data_ray
+        )
+        logging.info(
+            f"Autotune: {config['cpus_per_ray_worker']} CPUs per task, {config['workers']} workers, "
+            f"{config['partitions']} partitions, batch size {config['encode_batch_size']}: "
+            f"{throughput / 1024**2:.1f} MB/s"
+        )
+        measurements.append(dict(config, throughput_mb_s=throughput / 1024**2))
+
+    start = time.time()
+    for config in get_autotune_candidates(args, node_cpus):
+        measure(config)
+    best = max(measurements, key=lambda m: m["throughput_mb_s"])
+    for batch_size in (8, 32, 128):
+        if batch_size != best["encode_batch_size"]:
+            config = {field: value for field, value in best.items() if field != "throughput_mb_s"}
+            measure(dict(config, encode_batch_size=batch_size))
+    shutil.rmtree(calibration_dir, ignore_errors=True)
+
+    best = max(measurements, key=lambda m: m["throughput_mb_s"])
+    logging.info(f"Autotune: calibrated {len(measurements)} configurations in {time.time() - start:.0f}s")
+    return {
+        "key": get_autotune_key(args, node_cpus),
+        "config": {field: best[field] for field in measurements[0] if field != "throughput_mb_s"},
+        "throughput_mb_s": best["throughput_mb_s"],
+        "cluster_cpus": cluster_cpus,
+        "measurements": measurements,
+    }
+
+
+def run(args):
+    """Tokenize and merge every --input directory described by `args` (see `get_args`)."""
+    import ray
+
+    preprocess_data_ray = ray.remote(num_cpus=args.cpus_per_ray_worker)(preprocess_data_task)
     num_nodes = int(os.environ.get("SLURM_JOB_NUM_NODES", 1))
 
-    if num_nodes > 1:
+    if num_nodes > 1 or os.environ.get("RAY_ADDRESS"):
         ray.init(address="auto")
 
     elif args.workers:
         ray.init(num_cpus=args.workers)
 
-    ret = []
-    output_dir = args.output_prefix
-    os.makedirs(output_dir, exist_ok=True)
-    temp_output_dir = os.path.join(output_dir, "temp")
-    os.makedirs(temp_output_dir, exist_ok=True)
-
-    all_jsonl_files = glob.glob(
-        f"{args.input}/*.jsonl"
-    )  # TODO: Add support for other formats
-    logging.info(f"Found {len(all_jsonl_files)} files total")
-    logging.info(f"Checking for tokenized files in: {temp_output_dir}")
-    
-    # Filter out already tokenized files (except last 10)
-    # Check in temp_output_dir since that's where individual file outputs go
-    files_to_process = filter_files_to_process(all_jsonl_files, temp_output_dir, args.json_keys, keep_last_n=10)
-    logging.info(f"Processing {len(files_to_process)} files (skipped {len(all_jsonl_files) - len(files_to_process)} already tokenized files)")
-
-    for file in files_to_process:
-        output_prefix = os.path.join(temp_output_dir, os.path.basename(file))
-        input_path = file
-        preprocess_data_args = argparse.Namespace(
-            input=input_path,
-            json_keys=args.json_keys,
-            split_sentences=args.split_sentences,
-            keep_newlines=args.keep_newlines,
-            append_eod=args.append_eod,
-            lang=args.lang,
-            output_prefix=output_prefix,
-            workers=args.workers,
-            partitions=args.partitions,
-            log_interval=args.log_interval,
-            keep_sequential_samples=args.keep_sequential_samples,
-            tokenizer_type=args.tokenizer_type,
-            vocab_size=args.vocab_size,
-            vocab_file=args.vocab_file,
-            merge_file=args.merge_file,
-            tokenizer_model=args.tokenizer_model,
-            tiktoken_pattern=args.tiktoken_pattern,
-            tiktoken_num_special_tokens=args.tiktoken_num_special_tokens,
-            tiktoken_special_tokens=args.tiktoken_special_tokens,
+    tokenizer_names = [t.tokenizer_name for t in get_tokenizer_args(args)]
+
+    # Skipped files are not hashed, so dedup only sees the files processed in this run
+    dedup_shards = None
+    if args.dedup != "none":
+        dedup_shards = [ray.remote(num_cpus=0)(DedupShard).remote() for _ in range(args.dedup_shards)]
+
+    jobs = []
+    tasks = []
+    for job_index, (input_dir, output_dir) in enumerate(zip(args.input, args.output_prefix)):
+        os.makedirs(output_dir, exist_ok=True)
+        temp_output_dir = os.path.join(output_dir, "temp")
+        os.makedirs(temp_output_dir, exist_ok=True)
+
+        all_input_files = [
+            path for extension in INPUT_FORMATS for path in glob.glob(f"{input_dir}/*{extension}")
+        ]
+        logging.info(f"Found {len(all_input_files)} files total in {input_dir}")
+        logging.info(f"Checking for tokenized files in: {temp_output_dir}")
+
+        # Filter out merged, quarantined and already tokenized files (except last 10)
+        # Check in temp_output_dir since that's where individual file outputs go
+        manifest = load_manifest(output_dir)
+        files_to_process = filter_files_to_process(
+            all_input_files,
+            temp_output_dir,
+            args.json_keys,
+            keep_last_n=10,
+            tokenizer_names=tokenizer_names,
+            manifest=manifest,
+            retry_quarantined=args.retry_quarantined,
+        )
+        logging.info(f"Processing {len(files_to_process)} files (skipped {len(all_input_files) - len(files_to_process)} already tokenized files)")
+
+        job = {
+            "output_dir": output_dir,
+            "temp_output_dir": temp_output_dir,
+            "pending": len(files_to_process),
+            "dedup_stats": [],
+            "staging_dir": (
+                os.path.join(args.scratch_dir, f"job{job_index:03d}") if args.scratch_dir else None
+            ),
+            "staged_nodes": set(),
+            "files": all_input_files,
+            "manifest": manifest,
+            "quarantined": [],
+            # only a merged dataset recorded in the manifest is extended, an
+            # older one is rebuilt from all inputs
+            "extend_merged": any(entry["status"] == "merged" for entry in manifest.values()),
+            # changed files whose old documents are in the merged dataset
+            "reprocessed_merged": {
+                os.path.basename(file)
+                for file in files_to_process
+                if manifest.get(os.path.basename(file), {}).get("status") == "merged"
+            },
+        }
+        jobs.append(job)
+        tasks.extend((file, job) for file in files_to_process)
+
+    # All directories share one queue; largest files first keeps the tail short
+    tasks.sort(key=lambda task: os.path.getsize(task[0]), reverse=True)
+
+    # The configuration is locked in before the first task is submitted
+    if args.autotune and tasks:
+        node_cpus = int(
+            max(node["Resources"].get("CPU", 0) for node in ray.nodes() if node["Alive"])
+        )
+        key = get_autotune_key(args, node_cpus)
+        record = None
+        if not args.autotune_refresh:
+            record = load_autotune([job["output_dir"] for job in jobs], key)
+        if record is not None:
+            logging.info(f"Autotune: reusing the configuration recorded for {node_cpus}-CPU nodes")
+        else:
+            calibration_files = [file for file, _ in tasks if file.endswith(".jsonl")]
+            if calibration_files:
+                record = autotune(
+                    args,
+                    calibration_files[: args.autotune_inputs],
+                    os.path.join(jobs[0]["temp_output_dir"], "autotune"),
+                    preprocess_data_ray,
+                    node_cpus,
+                )
+            else:
+                logging.warning("Autotune needs .jsonl inputs to calibrate on, keeping the given configuration")
+        if record is not None:
+            for job in jobs:
+                with open(get_autotune_path(job["output_dir"]), "w") as f:
+                    json.dump(record, f, indent=1)
+            vars(args).update(record["config"])
+            logging.info(
+                f"Autotune: {args.cpus_per_ray_worker} CPUs per task, {args.workers} workers, "
+                f"{args.partitions} partitions, batch size {args.encode_batch_size} "
+                f"(~{record['throughput_mb_s']:.1f} MB/s in calibration)"
+            )
+
+    # With staging, each task prefetches the input of the task expected to
+    # start when its slot frees up. That is only reliably the same node on
+    # single-node clusters, so multi-node tasks just stage their own input.
+    prefetch_distance = None
+    if args.scratch_dir and len(ray.nodes()) == 1:
+        prefetch_distance = max(
+            1, int(ray.cluster_resources().get("CPU", 1) // args.cpus_per_ray_worker)
         )
-        preprocess_data_args.rank = 1
-        preprocess_data_args.make_vocab_size_divisible_by = 128
-        preprocess_data_args.tensor_model_parallel_size = 1
-        preprocess_data_args.vocab_extra_ids = 0
-        ret.append(preprocess_data_ray.remote(preprocess_data_args))
+
+    # Tasks declare their estimated memory to Ray and are only submitted while
+    # the estimates of all running tasks fit the budget; at least one task
+    # always runs, so a task larger than the budget runs alone.
+    memory_budget = args.memory_budget_gb * 1024**3 if args.memory_budget_gb else None
+    if memory_budget is None:
+        memory_budget = ray.cluster_resources().get("memory", float("inf"))
+    # a single task can never get more than the largest node has
+    node_memory = max(
+        (node["Resources"].get("memory", 0) for node in ray.nodes() if node["Alive"]),
+        default=0,
+    ) or float("inf")
+    estimator = TaskMemoryEstimator(
+        args.task_memory_base_gb * 1024**3,
+        args.task_memory_per_doc_kb * 1024,
+        line_index_dir=args.line_index_dir,
+    )
+
+    failed_jobs = []
+
+    def finish(job):
+        # a failed merge keeps temp/ and the manifest, so the next run merges again
+        try:
+            finish_job(args, job, tokenizer_names)
+        except Exception:
+            logging.exception(f"Merging {job['output_dir']} failed")
+            failed_jobs.append(job)
 
     start = time.time()
-    ray.get(ret)
+    for job in jobs:
+        if job["pending"] == 0:
+            finish(job)
+
+    in_flight = {}
+    memory_in_use = 0
+    next_task = 0
+    while next_task < len(tasks) or in_flight:
+        while next_task < len(tasks):
+            file, job = tasks[next_task]
+            memory = min(estimator.estimate(file), memory_budget, node_memory)
+            if in_flight and memory_in_use + memory > memory_budget:
+                break
+            output_dir = job["temp_output_dir"]
+            if job["staging_dir"]:
+                output_dir = os.path.join(job["staging_dir"], "temp")
+            output_prefix = os.path.join(output_dir, os.path.basename(file))
+            preprocess_data_args = make_preprocess_data_args(
+                args, file, output_prefix, staging_dir=job["staging_dir"]
+            )
+            prefetch_input = None
+            if prefetch_distance and next_task + prefetch_distance < len(tasks):
+                next_file, next_job = tasks[next_task + prefetch_distance]
+                prefetch_input = (next_file, os.path.join(next_job["staging_dir"], "inputs"))
+            # crashed workers and I/O errors are retried, malformed inputs are not
+            ref = preprocess_data_ray.options(
+                num_cpus=args.cpus_per_ray_worker,
+                memory=int(memory),
+                max_retries=args.task_retries,
+                retry_exceptions=[OSError, RuntimeError],
+            ).remote(preprocess_data_args, dedup_shards, prefetch_input)
+            in_flight[ref] = (job, memory, file, output_prefix, get_input_signature(file))
+            memory_in_use += memory
+            next_task += 1
+
+        # Merge each directory as soon as its last file is done, while others keep running
+        done, _ = ray.wait(list(in_flight), num_returns=1)
+        job, memory, file, output_prefix, signature = in_flight.pop(done[0])
+        memory_in_use -= memory
+        try:
+            result = ray.get(done[0])
+        except Exception as e:
+            # retries are exhausted: quarantine the input, the rest of its job is still merged
+            logging.error(f"Quarantining {file}: {e}")
+            if not job["staging_dir"]:
+                remove_file_outputs(output_prefix)
+            job["quarantined"].append(file)
+            # its documents are not merged, so they must not suppress later duplicates
+            if dedup_shards:
+                owner = get_dedup_owner(file)
+                ray.get([shard.remove_owner.remote(owner) for shard in dedup_shards])
+            job["manifest"][os.path.basename(file)] = dict(
+                signature, status="quarantined", error=str(e)[-2000:]
+            )
+        else:
+            estimator.update(result["documents"], result["input_bytes"], result["peak_memory"])
+            if result["dedup_stats"] is not None:
+                job["dedup_stats"].append(result["dedup_stats"])
+            if job["staging_dir"]:
+                job["staged_nodes"].add(result["node_id"])
+            job["manifest"][os.path.basename(file)] = dict(
+                signature, status="tokenized", **result["encode_stats"]
+            )
+        write_manifest(job["output_dir"], job["manifest"])
+        job["pending"] -= 1
+        if job["pending"] == 0:
+            finish(job)
 
     logging.info(f"Time taken: {time.time() - start}")
+    quarantined = sum(len(job["quarantined"]) for job in jobs)
+    if quarantined or failed_jobs:
+        logging.warning(
+            f"{quarantined} inputs were quarantined and {len(failed_jobs)} merges failed; "
+            f"rerun to retry failed merges, with --retry-quarantined to retry inputs"
+        )
     ray.shutdown()
 
-    logging.info("=====Merging datasets=====\n")
 
-    merge_datasets_args = argparse.Namespace(
-        input=temp_output_dir,
-        output_prefix=os.path.join(output_dir, "merged"),
-        multimodal=False,
+def sample_input(path, encoder, fraction, max_docs, batch_size=64):
+    """
+    Encode a deterministic, length-biased sample of the documents of `path`.
+
+    Byte offsets are drawn uniformly with a seed derived from the file name,
+    so a document is picked with probability proportional to its size and
+    per-byte averages over the sample (tokens / bytes, 1 / bytes, ...) are
+    unbiased estimates of the file's totals divided by its size. Sampling
+    stops at `fraction` of the estimated documents or at `max_docs`.
+
+    Returns:
+        List of (bytes, seconds, encoded) per sampled document, with `encoded`
+        as returned by `MultiEncoder.encode`.
+    """
+    size = os.path.getsize(path)
+    rng = np.random.default_rng(zlib.crc32(os.path.basename(path).encode("utf-8")))
+    samples = []
+    encoded_lines = {}
+    with open(path, "rb") as fin:
+        while len(samples) < max_docs:
+            if samples and len(samples) >= fraction * size * np.mean([1.0 / s[0] for s in samples]):
+                break
+            offsets = np.sort(rng.integers(0, size, min(batch_size, max_docs - len(samples))))
+            for offset in offsets:
+                start, line = read_line_at(fin, int(offset))
+                if start not in encoded_lines:
+                    encode_start = time.time()
+                    encoded, _ = encoder.encode(line)
+                    if isinstance(encoded, str):
+                        # malformed lines are skipped like filtered documents
+                        encoded = None
+                    encoded_lines[start] = (len(line), time.time() - encode_start, encoded)
+                samples.append(encoded_lines[start])
+    return samples
+
+
+def sample_columnar_input(path, input_format, encoder, columns, fraction, max_docs, batch_size=64):
+    """
+    Encode a deterministic, uniform sample of the rows of a Parquet or Arrow file.
+
+    Rows are drawn without replacement with a seed derived from the file name
+    and each is given an equal share of the file size as its bytes, so the
+    per-byte averages of `dry_run` stay unbiased. Only `columns` are read.
+    Like `sample_input`, at least one batch of `batch_size` rows is encoded.
+
+    Returns:
+        Same as `sample_input`
+    """
+    import pyarrow.dataset as ds
+
+    size = os.path.getsize(path)
+    if input_format == "arrow" and not is_arrow_ipc_file(path):
+        import pyarrow as pa
+
+        # memory mapped, so only the sampled rows are read
+        dataset = ds.dataset(pa.ipc.open_stream(pa.memory_map(path)).read_all())
+    else:
+        dataset = ds.dataset(path, format=input_format)
+    num_rows = dataset.count_rows()
+    if num_rows == 0:
+        return []
+
+    rng = np.random.default_rng(zlib.crc32(os.path.basename(path).encode("utf-8")))
+    num_samples = min(max_docs, max(batch_size, int(fraction * num_rows)), num_rows)
+    indices = np.sort(rng.choice(num_rows, num_samples, replace=False))
+    samples = []
+    for row in dataset.take(indices, columns=columns).to_pylist():
+        line = json.dumps(row, ensure_ascii=False)
+        encode_start = time.time()
+        encoded, _ = encoder.encode(line)
+        if isinstance(encoded, str):
+            encoded = None
+        samples.append((size / num_rows, time.time() - encode_start, encoded))
+    return samples
+
+
+def dry_run(args):
+    """
+    Estimate a full run of `args` from a sample of its inputs, without Ray.
+
+    Every input is sampled with `sample_input` (Parquet and Arrow inputs with
+    `sample_columnar_input`, without timing their conversion) and encoded in
+    this process.
+    Documents, tokens, sequences and encoding time are extrapolated per input
+    from their per-byte sample averages (inputs not sampled within
+    --dry-run-seconds use the average of all samples). Output sizes follow the
+    .bin/.idx layout, task memory uses `TaskMemoryEstimator` with the measured
+    size of an encoder process, and the wall time assumes --dry-run-cpus are
+    shared by tasks of --cpus-per-ray-worker CPUs with --workers encoders each.
+    Already tokenized files are not skipped, so this sizes a fresh run.
+
+    Returns:
+        Dictionary with the estimates that are also logged.
+    """
+    from megatron.core.datasets.indexed_dataset import DType
+
+    start = time.time()
+    args = add_tokenizer_defaults(argparse.Namespace(**vars(args)))
+    tokenizer_args = get_tokenizer_args(args)
+    encoder = MultiEncoder(args, tokenizer_args)
+    encoder.initializer()
+    process_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    itemsizes = [np.dtype(DType.optimal_dtype(t.vocab_size)).itemsize for t in MultiEncoder.tokenizers]
+
+    files = [
+        path
+        for input_dir in args.input
+        for path in sorted(
+            path for extension in INPUT_FORMATS for path in glob.glob(f"{input_dir}/*{extension}")
+        )
+        if os.path.getsize(path) > 0
+    ]
+    if not files:
+        logging.warning(f"Dry run found no input files in {args.input}")
+        return {}
+    # the text and the top-level filter columns of Parquet/Arrow inputs
+    columns = list(
+        dict.fromkeys(
+            list(args.json_keys)
+            + [column.split(".")[0] for column, _, _ in RowFilter(args).conditions]
+        )
     )
+    sizes = {path: os.path.getsize(path) for path in files}
+    total_size = sum(sizes.values())
+    # sample in a fixed pseudo-random order, so a time-limited sample is not
+    # biased towards one directory
+    order = sorted(files, key=lambda path: zlib.crc32(os.path.basename(path).encode("utf-8")))
+
+    # per sample: [1, seconds, tokens per tokenizer and key, sequences per tokenizer and key] / bytes
+    num_keys = len(tokenizer_args) * len(args.json_keys)
+    empty = [({key: [] for key in args.json_keys},) * 2] * len(tokenizer_args)
+    rates = {}
+    num_samples = 0
+    for path in order:
+        if rates and time.time() - start > args.dry_run_seconds:
+            logging.warning(f"Dry run time budget exhausted after sampling {len(rates)} of {len(files)} files")
+            break
+        max_docs = max(1, int(args.dry_run_max_docs * sizes[path] / total_size))
+        input_format = INPUT_FORMATS[os.path.splitext(path)[1]]
+        if input_format == "jsonl":
+            samples = sample_input(path, encoder, args.dry_run_fraction, max_docs)
+        else:
+            samples = sample_columnar_input(
+                path, input_format, encoder, columns, args.dry_run_fraction, max_docs
+            )
+        if not samples:
+            # a Parquet/Arrow file without rows
+            rates[path] = np.zeros((0, 2 + 2 * num_keys))
+            continue
+        # documents rejected by --filter or malformed count as encoded without output
+        rates[path] = np.array(
+            [
+                [float(encoded is not None), seconds]
+                + [len(ids[key]) for ids, _ in encoded or empty for key in args.json_keys]
+                + [len(lens[key]) for _, lens in encoded or empty for key in args.json_keys]
+                for size, seconds, encoded in samples
+            ],
+            dtype=np.float64,
+        ) / np.array([size for size, _, _ in samples], dtype=np.float64)[:, None]
+        num_samples += len(samples)
 
-    merge_datasets(merge_datasets_args)
+    pooled = np.concatenate(list(rates.values()))
+    totals = {}
+    for path in files:
+        rate = rates.get(path, pooled)
+        totals[path] = sizes[path] * rate.mean(axis=0) if len(rate) else np.zeros(2 + 2 * num_keys)
+    total = np.sum(list(totals.values()), axis=0)
+    documents = total[0]
+    tokens = total[2:2 + num_keys].reshape(len(tokenizer_args), len(args.json_keys))
+    sequences = total[2 + num_keys:].reshape(len(tokenizer_args), len(args.json_keys))
+    # relative standard error of the token count, from the spread of the sample
+    token_rates = pooled[:, 2:2 + num_keys].sum(axis=1)
+    token_error = token_rates.std() / max(token_rates.mean(), 1e-12) / math.sqrt(len(token_rates))
 
-    shutil.rmtree(temp_output_dir)
+    # 34 byte header, int32 length and int64 pointer per sequence, int64 per document boundary
+    bin_bytes = [tokens[k].sum() * itemsize for k, itemsize in enumerate(itemsizes)]
+    idx_bytes = [
+        len(args.json_keys) * (34 * len(files) + 8 * (documents + len(files))) + 12 * sequences[k].sum()
+        for k in range(len(tokenizer_args))
+    ]
+
+    slots = max(1, args.dry_run_cpus // args.cpus_per_ray_worker)
+    encode_seconds = {path: totals[path][1] for path in files}
+    wall_seconds = max(
+        sum(encode_seconds.values()) / (slots * args.workers),
+        max(encode_seconds.values()) / args.workers,
+    )
+
+    estimator = TaskMemoryEstimator(
+        (args.workers + 1) * process_memory, args.task_memory_per_doc_kb * 1024, args.line_index_dir
+    )
+    task_memory = sorted(
+        (
+            estimator.safety_factor * (estimator.base_bytes + estimator.bytes_per_doc * totals[path][0])
+            for path in files
+        ),
+        reverse=True,
+    )
+
+    report = {
+        "files": len(files),
+        "sampled_files": len(rates),
+        "sampled_documents": num_samples,
+        "input_bytes": total_size,
+        "documents": int(documents),
+        "tokens": {t.tokenizer_name: int(tokens[k].sum()) for k, t in enumerate(tokenizer_args)},
+        "token_relative_error": float(token_error),
+        "bin_bytes": {t.tokenizer_name: int(bin_bytes[k]) for k, t in enumerate(tokenizer_args)},
+        "idx_bytes": {t.tokenizer_name: int(idx_bytes[k]) for k, t in enumerate(tokenizer_args)},
+        "encode_cpu_seconds": float(sum(encode_seconds.values())),
+        "wall_seconds": float(wall_seconds),
+        "task_memory_bytes": int(task_memory[0]),
+        "concurrent_memory_bytes": int(sum(task_memory[:slots])),
+    }
+
+    logging.info(
+        f"Dry run: sampled {num_samples} documents from {len(rates)} of {len(files)} files "
+        f"in {time.time() - start:.1f}s"
+    )
+    logging.info(f"Input: {total_size / 1024**3:.2f} GB, ~{documents:.4g} documents")
+    for k, t_args in enumerate(tokenizer_args):
+        name = t_args.tokenizer_name or t_args.tokenizer_type
+        logging.info(
+            f"{name}: ~{tokens[k].sum():.4g} tokens (±{100 * token_error:.1f}%), "
+            f".bin {bin_bytes[k] / 1024**3:.2f} GB, .idx {idx_bytes[k] / 1024**3:.2f} GB "
+            f"(written twice: per-file outputs and merged)"
+        )
+    logging.info(
+        f"Encoding: {sum(encode_seconds.values()) / 3600:.2f} CPU hours, "
+        f"~{wall_seconds / 3600:.2f} h wall time with {slots} tasks x {args.workers} workers"
+    )
+    logging.info(
+        f"Memory: {task_memory[0] / 1024**3:.2f} GB for the largest task, "
+        f"{sum(task_memory[:slots]) / 1024**3:.2f} GB for {slots} concurrent tasks"
+    )
+    return report
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    args = get_args(argv)
+    if args.dry_run:
+        dry_run(args)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 #!/bin/bash
 
 # Script to submit tokenizer jobs for each subdirectory in Stack-Edu Code
+# (tokenizer_multinode.sh runs all of them in a single multi-node job instead)
 
 # Base paths
 BASE_INPUT_PATH="/p/data1/datasets/mmlaion/language/raw/stack-edu/Code/jsonl_data"
@@ -0,0 +1,19 @@
+import os
+import sys
+import types
+
+import pytest
+
+# the scripts live at the repository root and are not installed as a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def indexed_dataset(monkeypatch):
+    """Megatron's indexed_dataset module, replaced by the stand-in in indexed_dataset_stub.py."""
+    import indexed_dataset_stub
+
+    for name in ("megatron", "megatron.core", "megatron.core.datasets"):
+        monkeypatch.setitem(sys.modules, name, types.ModuleType(name))
+    monkeypatch.setitem(sys.modules, "megatron.core.datasets.indexed_dataset", indexed_dataset_stub)
+    return indexed_dataset_stub
@@ -0,0 +1,127 @@
+"""
+Stand-in for `megatron.core.datasets.indexed_dataset` with the parts the
+scripts use. It reads and writes the same MMIDIDX .bin/.idx layout, so the
+tests exercise the real file format without Megatron installed.
+"""
+
+import shutil
+import struct
+
+import numpy as np
+
+_INDEX_HEADER = b"MMIDIDX\x00\x00"
+
+_DTYPES = {
+    1: np.uint8,
+    2: np.int8,
+    3: np.int16,
+    4: np.int32,
+    5: np.int64,
+    6: np.float64,
+    7: np.float32,
+    8: np.uint16,
+}
+
+
+class DType(object):
+    @classmethod
+    def code_from_dtype(cls, value):
+        for code, dtype in _DTYPES.items():
+            if np.dtype(dtype) == np.dtype(value):
+                return code
+        raise ValueError(f"unsupported dtype {value}")
+
+    @classmethod
+    def optimal_dtype(cls, cardinality):
+        if cardinality is not None and cardinality < 65500:
+            return np.uint16
+        return np.int32
+
+
+def get_bin_path(path_prefix):
+    return path_prefix + ".bin"
+
+
+def get_idx_path(path_prefix):
+    return path_prefix + ".idx"
+
+
+class _IndexReader(object):
+    def __init__(self, idx_path):
+        with open(idx_path, "rb") as f:
+            data = f.read()
+        assert data[: len(_INDEX_HEADER)] == _INDEX_HEADER
+        offset = len(_INDEX_HEADER)
+        (version,) = struct.unpack_from("<Q", data, offset)
+        assert version == 1
+        self.dtype = _DTYPES[data[offset + 8]]
+        sequence_count, document_count = struct.unpack_from("<QQ", data, offset + 9)
+        offset += 25
+        self.sequence_lengths = np.frombuffer(data, np.int32, sequence_count, offset)
+        offset += self.sequence_lengths.nbytes
+        self.sequence_pointers = np.frombuffer(data, np.int64, sequence_count, offset)
+        offset += self.sequence_pointers.nbytes
+        self.document_indices = np.frombuffer(data, np.int64, document_count, offset)
+
+    def __len__(self):
+        return len(self.sequence_lengths)
+
+
+class IndexedDataset(object):
+    def __init__(self, path_prefix, multimodal=False):
+        self.index = _IndexReader(get_idx_path(path_prefix))
+        with open(get_bin_path(path_prefix), "rb") as f:
+            self.bin = np.frombuffer(f.read(), dtype=self.index.dtype)
+
+    @property
+    def document_indices(self):
+        return self.index.document_indices
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        return self.get(idx)
+
+    def get(self, idx, offset=0, length=None):
+        start = self.index.sequence_pointers[idx] // np.dtype(self.index.dtype).itemsize + offset
+        if length is None:
+            length = self.index.sequence_lengths[idx] - offset
+        return self.bin[start : start + length].copy()
+
+
+class IndexedDatasetBuilder(object):
+    def __init__(self, bin_path, dtype=np.int32, multimodal=False):
+        self.data_file = open(bin_path, "wb")
+        self.dtype = dtype
+        self.sequence_lengths = []
+        self.document_indices = [0]
+
+    def add_document(self, tensor, lengths, modes=None):
+        self.data_file.write(np.asarray(tensor, dtype=self.dtype).tobytes(order="C"))
+        self.sequence_lengths.extend(lengths)
+        self.document_indices.append(len(self.sequence_lengths))
+
+    def add_index(self, path_prefix):
+        index = _IndexReader(get_idx_path(path_prefix))
+        assert index.dtype == self.dtype
+        offset = len(self.sequence_lengths)
+        self.sequence_lengths.extend(index.sequence_lengths.tolist())
+        self.document_indices.extend((index.document_indices[1:] + offset).tolist())
+        with open(get_bin_path(path_prefix), "rb") as f:
+            shutil.copyfileobj(f, self.data_file)
+
+    def finalize(self, idx_path):
+        self.data_file.close()
+        sequence_lengths = np.array(self.sequence_lengths, dtype=np.int32)
+        sequence_bytes = sequence_lengths.astype(np.int64) * np.dtype(self.dtype).itemsize
+        sequence_pointers = np.concatenate([[0], np.cumsum(sequence_bytes)])[:-1]
+        with open(idx_path, "wb") as f:
+            f.write(_INDEX_HEADER)
+            f.write(struct.pack("<Q", 1))
+            f.write(struct.pack("<B", DType.code_from_dtype(self.dtype)))
+            f.write(struct.pack("<Q", len(sequence_lengths)))
+            f.write(struct.pack("<Q", len(self.document_indices)))
+            f.write(sequence_lengths.tobytes(order="C"))
+            f.write(sequence_pointers.astype(np.int64).tobytes(order="C"))
+            f.write(np.array(self.document_indices, dtype=np.int64).tobytes(order="C"))
@@ -0,0 +1,218 @@
+"""
+Round trips through the dataset stages that work on tokenized outputs: merging
+(in order and shuffled), subsets and splits, mixtures and sequence packing.
+Small datasets are written with the stand-in for Megatron's indexed_dataset
+module (see conftest.py) and read back document by document.
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pytest
+
+import build_mixture
+import build_subset
+from preprocess_data_parallel import (
+    PackedDataset,
+    build_packed_sample_index,
+    load_document_sources,
+    merge_datasets,
+)
+
+# per input file: documents, each a list of token ids; some are empty
+FILES = {
+    "a.jsonl_text_document": [[1, 2, 3], [], [4, 5], [6] * 11, [7, 8, 9, 10]],
+    "b.jsonl_text_document": [[20, 21], [22] * 5, []],
+    "c.jsonl_text_document": [[30 + i for i in range(n)] for n in (1, 9, 3, 6, 2, 7)],
+}
+
+
+def write_dataset(indexed_dataset, path_prefix, documents):
+    builder = indexed_dataset.IndexedDatasetBuilder(path_prefix + ".bin", dtype=np.uint16)
+    for document in documents:
+        builder.add_document(document, [len(document)] if document else [])
+    builder.finalize(path_prefix + ".idx")
+
+
+def read_documents(indexed_dataset, path_prefix):
+    dataset = indexed_dataset.IndexedDataset(path_prefix)
+    document_indices = dataset.index.document_indices
+    return [
+        [token for sequence in range(start, end) for token in dataset[sequence].tolist()]
+        for start, end in zip(document_indices[:-1], document_indices[1:])
+    ]
+
+
+def read_sources(path_prefix):
+    names, ids = load_document_sources(path_prefix)
+    return [names[i] for i in ids]
+
+
+@pytest.fixture
+def merged(indexed_dataset, tmp_path):
+    """Prefix of the per-file outputs of FILES merged in order."""
+    temp_dir = tmp_path / "temp"
+    temp_dir.mkdir()
+    for name, documents in FILES.items():
+        write_dataset(indexed_dataset, str(temp_dir / name), documents)
+    output_prefix = str(tmp_path / "merged")
+    merge_datasets(
+        argparse.Namespace(input=str(temp_dir), output_prefix=output_prefix, multimodal=False)
+    )
+    return output_prefix
+
+
+ALL_DOCUMENTS = [document for documents in FILES.values() for document in documents]
+ALL_SOURCES = [name for name, documents in FILES.items() for _ in documents]
+
+
+def test_merge(indexed_dataset, merged):
+    assert read_documents(indexed_dataset, merged) == ALL_DOCUMENTS
+    assert read_sources(merged) == ALL_SOURCES
+    # merges are written under a temporary prefix and renamed
+    assert sorted(os.listdir(os.path.dirname(merged))) == [
+        "merged.bin",
+        "merged.idx",
+        "merged_sources.json",
+        "merged_sources.npy",
+        "temp",
+    ]
+
+
+@pytest.mark.parametrize("shuffle_buffer_mb", [1, 0.0001])
+def test_shuffled_merge(indexed_dataset, merged, shuffle_buffer_mb):
+    def shuffle(seed):
+        output_prefix = f"{merged}_shuffled_{seed}"
+        merge_datasets(
+            argparse.Namespace(
+                input=os.path.join(os.path.dirname(merged), "temp"),
+                output_prefix=output_prefix,
+                multimodal=False,
+                shuffle=True,
+                shuffle_seed=seed,
+                shuffle_buffer_mb=shuffle_buffer_mb,
+            )
+        )
+        return read_documents(indexed_dataset, output_prefix), read_sources(output_prefix)
+
+    documents, sources = shuffle(1)
+    assert sorted(documents) == sorted(ALL_DOCUMENTS)
+    assert documents != ALL_DOCUMENTS
+    # the provenance is permuted along with the documents
+    assert sorted(zip(map(tuple, documents), sources)) == sorted(
+        zip(map(tuple, ALL_DOCUMENTS), ALL_SOURCES)
+    )
+    assert shuffle(1) == (documents, sources)
+    assert shuffle(2) != (documents, sources)
+
+
+@pytest.mark.parametrize("copy", [False, True])
+def test_subset(indexed_dataset, merged, copy):
+    output_prefix = merged + "_subset"
+    build_subset.main(
+        ["--input-prefix", merged, "--output-prefix", output_prefix, "--exclude-sources", "b.*"]
+        + (["--copy"] if copy else [])
+    )
+    expected = [
+        (document, source)
+        for document, source in zip(ALL_DOCUMENTS, ALL_SOURCES)
+        if not source.startswith("b.")
+    ]
+    assert read_documents(indexed_dataset, output_prefix) == [document for document, _ in expected]
+    assert read_sources(output_prefix) == [source for _, source in expected]
+    assert os.path.samefile(merged + ".bin", output_prefix + ".bin") != copy
+
+
+def test_subset_survives_rebuilt_merge(indexed_dataset, merged):
+    output_prefix = merged + "_subset"
+    build_subset.main(["--input-prefix", merged, "--output-prefix", output_prefix])
+    temp_dir = os.path.join(os.path.dirname(merged), "temp")
+    for name in FILES:
+        write_dataset(indexed_dataset, os.path.join(temp_dir, name), [[99] * 4])
+    merge_datasets(argparse.Namespace(input=temp_dir, output_prefix=merged, multimodal=False))
+    assert read_documents(indexed_dataset, merged) == [[99] * 4] * len(FILES)
+    assert read_documents(indexed_dataset, output_prefix) == ALL_DOCUMENTS
+
+
+def test_split(indexed_dataset, merged):
+    build_subset.main(
+        ["--input-prefix", merged, "--output-prefix", merged, "--split", "train=0.75", "valid=0.25"]
+    )
+    train = read_documents(indexed_dataset, merged + "_train")
+    valid = read_documents(indexed_dataset, merged + "_valid")
+    assert len(valid) > 0
+    assert sorted(train + valid) == sorted(ALL_DOCUMENTS)
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_mixture(indexed_dataset, merged, tmp_path, shuffle):
+    other = str(tmp_path / "other")
+    write_dataset(indexed_dataset, other, [[100 + i] * (i + 1) for i in range(10)])
+    output_prefix = str(tmp_path / "mix")
+    build_mixture.main(
+        ["--output-prefix", output_prefix, "--seed", "3"]
+        + ["--source", merged, "x2", "--source", other, "20"]
+        + (["--shuffle"] if shuffle else [])
+    )
+    documents = read_documents(indexed_dataset, output_prefix)
+    sources = read_sources(output_prefix)
+    assert len(documents) == len(sources)
+
+    from_merged = [d for d, source in zip(documents, sources) if source.startswith(merged + ":")]
+    from_other = [d for d, source in zip(documents, sources) if source.startswith(other + ":")]
+    assert sorted(from_merged) == sorted(ALL_DOCUMENTS * 2)
+    # the budget is overshot by at most one document
+    tokens = sum(len(document) for document in from_other)
+    assert 20 <= tokens < 20 + 10
+    assert len(set(map(tuple, from_other))) == len(from_other)
+    assert (documents[: len(from_merged)] == from_merged) != shuffle
+
+    with open(output_prefix + "_mixture.json") as f:
+        stats = json.load(f)["sources"]
+    assert [s["tokens"] for s in stats] == [2 * sum(map(len, ALL_DOCUMENTS)), tokens]
+
+
+def test_empty_subset(indexed_dataset, merged, tmp_path):
+    documents_path = str(tmp_path / "none.npy")
+    np.save(documents_path, np.zeros(0, dtype=np.int64))
+    output_prefix = merged + "_empty"
+    build_subset.main(
+        ["--input-prefix", merged, "--output-prefix", output_prefix, "--copy"]
+        + ["--documents", documents_path]
+    )
+    assert read_documents(indexed_dataset, output_prefix) == []
+
+
+@pytest.mark.parametrize("seq_length", [3, 7, 15])
+def test_packing(indexed_dataset, merged, seq_length):
+    build_packed_sample_index(merged, seq_length)
+    dataset = PackedDataset(merged, seq_length, pad_id=0, seed=5)
+    samples = [dataset[i] for i in range(len(dataset))]
+
+    pieces = []
+    for sample in samples:
+        tokens, segment_ids = sample["tokens"], sample["segment_ids"]
+        assert len(tokens) == len(segment_ids) == seq_length + 1
+        # documents first, then padding
+        filled = np.count_nonzero(segment_ids)
+        assert np.all(np.diff(segment_ids[:filled]) >= 0) and segment_ids[:filled].all()
+        assert not tokens[filled:].any()
+        for segment in range(1, segment_ids.max() + 1):
+            pieces.append(tokens[segment_ids == segment].tolist())
+    # every token of every document is packed once, long documents are cut
+    assert sorted(token for piece in pieces for token in piece) == sorted(
+        token for document in ALL_DOCUMENTS for token in document
+    )
+    assert all(
+        any(
+            piece == document[i : i + len(piece)]
+            for document in ALL_DOCUMENTS
+            for i in range(len(document))
+        )
+        for piece in pieces
+    )
+    # samples are returned in a seeded random order, not packing order
+    unshuffled = PackedDataset(merged, seq_length, pad_id=0, seed=None)
+    assert sorted(dataset.order.tolist()) == list(range(len(unshuffled)))
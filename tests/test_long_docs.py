@@ -0,0 +1,81 @@
+"""
+Segmented encoding of long documents (--long-doc-chars) must match whole-document
+encoding for byte-level BPE tokenizers. A small GPT-2 style tokenizer is trained
+on the fly, so no tokenizer files are downloaded.
+"""
+
+import pytest
+
+from preprocess_data_parallel import find_segment_boundary, split_long_text
+
+tokenizers = pytest.importorskip("tokenizers")
+
+PROSE = (
+    "The quick brown fox jumps over the lazy dog.\n"
+    "It's a well-known pangram, isn't it?\n"
+    "Tokenizers split text into words, numbers and punctuation.\n"
+) * 20
+NUMBERS = " ".join(str(7 ** (i % 17)) for i in range(400))
+CODE = "y = (a + b[0]) * {'c': -1.5} / f(d, e) != g; " * 40
+TEXTS = {"newlines": PROSE, "spaces": PROSE.replace("\n", " "), "digits": NUMBERS, "punctuation": CODE}
+# a cut of every text must land on the boundary the text is named after,
+# given the text before and after the cut
+BOUNDARIES = {
+    "newlines": lambda before, after: before.endswith("\n"),
+    "spaces": lambda before, after: after[:1] == " " and after[1:2].isalpha(),
+    "digits": lambda before, after: after[:1] == " " and after[1:2].isdigit(),
+    "punctuation": lambda before, after: after[:1] == " " and not after[1:2].isalnum(),
+}
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    tokenizer = tokenizers.ByteLevelBPETokenizer()
+    tokenizer.train_from_iterator(
+        list(TEXTS.values()), vocab_size=600, min_frequency=1, show_progress=False
+    )
+    return tokenizer
+
+
+def encode_segments(tokenizer, segments):
+    return [token for segment in segments for token in tokenizer.encode(segment).ids]
+
+
+@pytest.mark.parametrize("name", sorted(TEXTS))
+@pytest.mark.parametrize("segment_chars", [40, 64, 100])
+def test_segments_match_whole_document(tokenizer, name, segment_chars):
+    text = TEXTS[name]
+    segments = split_long_text(text, segment_chars)
+    assert len(segments) > 1
+    assert "".join(segments) == text
+    assert all(len(segment) <= segment_chars for segment in segments)
+    # no hard cuts, and at least one of the kind under test
+    cuts = list(zip(segments[:-1], segments[1:]))
+    assert all(before.endswith("\n") or after.startswith(" ") for before, after in cuts)
+    assert any(BOUNDARIES[name](before, after) for before, after in cuts)
+    assert encode_segments(tokenizer, segments) == tokenizer.encode(text).ids
+
+
+@pytest.mark.parametrize(
+    "text, cut",
+    [
+        ("abc\ndef", 4),  # after a newline between non-whitespace
+        ("abc def", 3),  # before a space starting a word
+        ("abc 123", 3),  # before a space starting a number
+        ("abc (x)", 3),  # before a space starting punctuation
+        ("abc\n\ndef", None),  # newline runs are one pre-token
+        ("abc  def", None),  # so are runs of spaces
+    ],
+)
+def test_find_segment_boundary(text, cut):
+    assert find_segment_boundary(text, 1, len(text)) == cut
+
+
+def test_hard_cut_without_boundary(tokenizer):
+    text = "x" * 50 + " " + "1234567890" * 30 + " tail"
+    segments = split_long_text(text, 40)
+    assert "".join(segments) == text
+    # the boundary-free run is cut at exactly segment_chars
+    assert [len(segment) for segment in segments[1:-1]] == [40] * (len(segments) - 2)
+    ids = encode_segments(tokenizer, segments)
+    assert tokenizer.decode(ids) == text
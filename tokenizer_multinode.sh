@@ -0,0 +1,102 @@
+#!/bin/bash
+
+# Tokenizes all Stack-Edu languages in one job: a single Ray cluster spans all
+# nodes and every file goes into one global work queue, while each language
+# still gets its own merged output.
+
+#SBATCH --job-name=Stack-Edu
+#SBATCH --output=logs/tokenize/Stack-Edu/%x.out
+#SBATCH --error=logs/tokenize/Stack-Edu/%x.err
+#SBATCH --nodes=4
+#SBATCH --ntasks-per-node=1
+#SBATCH --time=1-00:00:00
+#SBATCH --account=laionize
+#SBATCH --partition=batch
+#SBATCH --cpus-per-task=48
+#SBATCH --mem=0
+
+module load CUDA
+module load GCC
+module load PyYAML
+
+# Export PYTHONPATH to include Megatron-LM only
+export PYTHONPATH="$(pwd)/Megatron-LM"
+echo "PYTHONPATH set to: $PYTHONPATH"
+
+BASE_INPUT_PATH="/p/data1/datasets/mmlaion/language/raw/stack-edu/Code/jsonl_data"
+BASE_OUTPUT_PATH="/p/data1/datasets/mmlaion/mahadik1/tokenized_cosmo2/Stack-Edu"
+
+# List of subdirectories (languages)
+SUBDIRS=(
+    "C"
+    "CSharp"
+    "Cpp"
+    "Go"
+    "Java"
+    "JavaScript"
+    "Markdown"
+    "PHP"
+    "Python"
+    "Ruby"
+    "Rust"
+    "SQL"
+    "Shell"
+    "Swift"
+    "TypeScript"
+)
+
+INPUTS=""
+OUTPUTS=""
+for SUBDIR in "${SUBDIRS[@]}"; do
+    INPUTS="$INPUTS ${BASE_INPUT_PATH}/${SUBDIR}/"
+    OUTPUTS="$OUTPUTS ${BASE_OUTPUT_PATH}/${SUBDIR}/"
+done
+
+TOKENIZER_TYPE="HuggingFaceTokenizer"
+# Use the local cached tokenizer path instead of model name to avoid HF hub lookups
+TOKENIZER_MODEL="/p/project1/projectnucleus/mahadik1/.cache/huggingface/models--HuggingFaceTB--cosmo2-tokenizer/snapshots/4ce2318a3628e77279c939ed6a9f3f03034402de"
+CPUS_PER_WORKER=6
+SCRIPT="/p/project1/projectnucleus/mahadik1/Megatron-LM/preprocess_data_parallel.py"
+export HF_HUB_OFFLINE=1
+
+source /p/project1/projectnucleus/mahadik1/.python/.tvenv/bin/activate
+
+# Start the Ray head on the first node and a Ray worker on every other node
+NODES=($(scontrol show hostnames "$SLURM_JOB_NODELIST"))
+HEAD_NODE=${NODES[0]}
+HEAD_NODE_IP=$(srun --nodes=1 --ntasks=1 -w "$HEAD_NODE" hostname --ip-address)
+RAY_PORT=6379
+
+echo "Starting Ray head on $HEAD_NODE ($HEAD_NODE_IP)"
+srun --nodes=1 --ntasks=1 -w "$HEAD_NODE" \
+    ray start --head --node-ip-address="$HEAD_NODE_IP" --port=$RAY_PORT \
+    --num-cpus "$SLURM_CPUS_PER_TASK" --block &
+sleep 10
+
+for ((i = 1; i < SLURM_JOB_NUM_NODES; i++)); do
+    echo "Starting Ray worker on ${NODES[$i]}"
+    srun --nodes=1 --ntasks=1 -w "${NODES[$i]}" \
+        ray start --address "$HEAD_NODE_IP:$RAY_PORT" \
+        --num-cpus "$SLURM_CPUS_PER_TASK" --block &
+    sleep 5
+done
+
+export RAY_ADDRESS="$HEAD_NODE_IP:$RAY_PORT"
+
+# --workers is the encoder pool size of each Ray task
+CMD="python $SCRIPT \
+    --input $INPUTS \
+    --output-prefix $OUTPUTS \
+    --tokenizer-type $TOKENIZER_TYPE \
+    --tokenizer-model $TOKENIZER_MODEL \
+    --workers $CPUS_PER_WORKER \
+    --cpus-per-ray-worker $CPUS_PER_WORKER \
+    --json-keys text \
+    --append-eod"
+
+echo "Executing command:"
+echo "$CMD"
+
+bash -c "$CMD"
+
+echo "Job finished."